@@ -0,0 +1,281 @@
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+from xml.sax.saxutils import quoteattr
+from . import etree
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'osm_conflate')
+DEFAULT_TTL = 3600  # in seconds
+DEFAULT_MAX_SIZE = 500 * 1024 * 1024  # in bytes
+TILE_ZOOM = 12
+
+
+class ResponseCache:
+    """An on-disk cache for server responses.
+
+    Entries are gzipped files named after a hash of the query and the server.
+    They expire after "ttl" seconds (None means never), and when the total size
+    of the cache exceeds "max_size" bytes, least recently used entries are removed.
+    """
+    compress = True
+    single_file = False
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        # Threads storing entries evict them one at a time
+        self.evict_lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1('\n'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + '.osm.gz')
+
+    def is_expired(self, filename, now=None):
+        if self.ttl is None:
+            return False
+        return os.path.getmtime(filename) + self.ttl < (now or time.time())
+
+    def open(self, key):
+        """Returns a binary file object for the cache entry, or None if
+        it is missing or expired."""
+        filename = self.entry_path(key)
+        try:
+            if self.is_expired(filename):
+                return None
+            # Update the access time for LRU, keeping the mtime for TTL
+            os.utime(filename, (time.time(), os.path.getmtime(filename)))
+            if self.compress:
+                return gzip.open(filename, 'rb')
+            return open(filename, 'rb')
+        except FileNotFoundError:
+            # Missing, or evicted by another process
+            return None
+
+    def store(self, key, data, evict=True):
+        """Writes bytes into the cache entry."""
+        for _ in self.tee(key, [data], evict):
+            pass
+
+    def tee(self, key, chunks, evict=True):
+        """Yields chunks of bytes while writing them into the cache entry.
+        The entry is stored only after all chunks were consumed."""
+        filename = self.entry_path(key)
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_name = filename + '.tmp'
+        try:
+            with (gzip.open if self.compress else open)(tmp_name, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+        os.replace(tmp_name, filename)
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Removes expired entries, and then least recently used ones
+        until the cache fits into max_size. Entries in subdirectories,
+        like tiles of a TileCache, share the same budget."""
+        if not os.path.isdir(self.path):
+            return
+        with self.evict_lock:
+            now = time.time()
+            entries = []
+            total_size = 0
+            for dirpath, _, names in os.walk(self.path):
+                for name in names:
+                    if not name.endswith('.gz'):
+                        continue
+                    filename = os.path.join(dirpath, name)
+                    # Other processes can remove files at the same time
+                    try:
+                        if self.is_expired(filename, now):
+                            os.remove(filename)
+                            continue
+                        st = os.stat(filename)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_atime, st.st_size, filename))
+                    total_size += st.st_size
+            if self.max_size is None or total_size <= self.max_size:
+                return
+            entries.sort()
+            for _, size, filename in entries:
+                if total_size <= self.max_size:
+                    break
+                logging.debug('Evicting %s from the cache', filename)
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+
+class OsmFileCache(ResponseCache):
+    """A cache of a single uncompressed OSM file, which never expires
+    and is returned for any query.
+
+    When the file is missing, responses for all queries of a download are
+    collected with "tee_part", and then merged into the file with "write_parts".
+    """
+    compress = False
+    single_file = True
+
+    def __init__(self, filename):
+        super().__init__(os.path.dirname(filename), ttl=None, max_size=None)
+        self.filename = filename
+        self.parts = []
+        self.part_count = 0
+        self.lock = threading.Lock()
+
+    def entry_path(self, key):
+        return self.filename
+
+    def evict(self):
+        pass
+
+    def new_part(self):
+        """Returns a name for a new part file, see "tee_part"."""
+        with self.lock:
+            part = '{}.part{}'.format(self.filename, self.part_count)
+            self.part_count += 1
+            self.parts.append(part)
+        return part
+
+    def tee_part(self, part, chunks):
+        """Yields chunks of bytes while writing them into the part file.
+        The part is discarded when not all chunks were consumed."""
+        try:
+            with open(part, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+        except BaseException:
+            self.discard_part(part)
+            raise
+
+    def discard_part(self, part):
+        """Removes a part, e.g. of a failed response, so it is not written into the file."""
+        with self.lock:
+            if part in self.parts:
+                self.parts.remove(part)
+        if os.path.exists(part):
+            os.remove(part)
+
+    def write_parts(self):
+        """Writes objects from all part files into the file, and removes the parts."""
+        tmp_name = self.filename + '.tmp'
+        with open(tmp_name, 'wb') as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+            root = None
+            for part in self.parts:
+                depth = 0
+                for event, el in etree.iterparse(part, events=('start', 'end')):
+                    if event == 'start':
+                        if root is None:
+                            # Keeps the generator, which tells Overpass API responses
+                            # from full extracts, see Snapshot.full_extract
+                            root = ''.join(' {}={}'.format(k, quoteattr(v))
+                                           for k, v in el.attrib.items())
+                            f.write('<osm{}>\n'.format(root).encode('utf-8'))
+                        depth += 1
+                        continue
+                    depth -= 1
+                    if depth == 1 and el.tag in ('node', 'way', 'relation'):
+                        el.tail = '\n'
+                        f.write(etree.tostring(el, encoding='utf-8'))
+                        el.clear()
+            if root is None:
+                f.write(b'<osm version="0.6">\n')
+            f.write(b'</osm>\n')
+        os.replace(tmp_name, self.filename)
+        self.discard_parts()
+
+    def discard_parts(self):
+        for part in self.parts:
+            if os.path.exists(part):
+                os.remove(part)
+        self.parts = []
+
+
+class TileCache(ResponseCache):
+    """A cache of parsed OSM objects split into map tiles of a fixed zoom level.
+
+    Each tile is keyed by its coordinates and a query signature, and contains a list
+    of records made by OsmDownloader.parse_element for objects with centers inside it.
+    When "parent" is a ResponseCache, tiles are stored in its "tiles" subdirectory
+    and share its size budget.
+    """
+    def __init__(self, path=os.path.join(DEFAULT_CACHE_DIR, 'tiles'), ttl=DEFAULT_TTL,
+                 max_size=DEFAULT_MAX_SIZE, zoom=TILE_ZOOM, parent=None):
+        if parent is not None:
+            path = os.path.join(parent.path, 'tiles')
+            ttl = parent.ttl
+            max_size = parent.max_size
+        super().__init__(path, ttl, max_size)
+        self.zoom = zoom
+        self.parent = parent
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + '.json.gz')
+
+    def tile_key(self, signature, tile):
+        return '{}-{}-{}-{}'.format(signature, self.zoom, tile[0], tile[1])
+
+    def get_tile(self, lat, lon):
+        """Returns (x, y) of a tile containing the point."""
+        n = 2 ** self.zoom
+        lat = max(-85.0511, min(85.0511, lat))
+        x = int((lon + 180.0) / 360.0 * n)
+        y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+        return min(n - 1, max(0, x)), min(n - 1, max(0, y))
+
+    def tile_bbox(self, tile):
+        """Returns [min_lat, min_lon, max_lat, max_lon] for a tile."""
+        n = 2 ** self.zoom
+
+        def lat(y):
+            return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+        return [lat(tile[1] + 1), tile[0] / n * 360.0 - 180.0,
+                lat(tile[1]), (tile[0] + 1) / n * 360.0 - 180.0]
+
+    def tiles_for_bbox(self, bbox):
+        """Returns a list of tiles covering a bbox."""
+        x0, y0 = self.get_tile(bbox[2], bbox[1])
+        x1, y1 = self.get_tile(bbox[0], bbox[3])
+        return [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    def load(self, signature, tile):
+        """Returns a list of records for a tile, or None if it is not cached."""
+        f = self.open(self.tile_key(signature, tile))
+        if f is None:
+            return None
+        with f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def evict(self):
+        if self.parent is not None:
+            self.parent.evict()
+        else:
+            super().evict()
+
+    def save(self, signature, tile, records):
+        self.store(self.tile_key(signature, tile),
+                   json.dumps(records, ensure_ascii=False).encode('utf-8'), evict=False)
@@ -5,8 +5,15 @@ import json
 import logging
 import os
 import sys
+from .cache import ResponseCache, OsmFileCache, TileCache, DEFAULT_CACHE_DIR, TILE_ZOOM
 from .geocoder import Geocoder
+from .geojson import ChangesWriter, FORMATS
+from .mvt import TileBuilder
+from .local import LocalBackend
+from .overpass import OVERPASS_SERVER, ALT_OVERPASS_SERVER
 from .profile import Profile
+from .snapshot import Snapshot
+from .upload import Uploader, UploadError, BATCH_SIZE
 from .conflator import OsmConflator, TITLE
 from .dataset import (
     read_dataset,
@@ -85,11 +92,52 @@ def run(profile=None):
                         help='Optional parameter for the profile')
     parser.add_argument('--osc', action='store_true',
                         help='Produce an osmChange file instead of JOSM XML')
+    parser.add_argument('--chunk-size', type=int,
+                        help='Split the output into files of at most this many objects, ' +
+                        'and write a JSON index of them to the output file')
+    parser.add_argument('--chunk-area', type=float,
+                        help='Split the output into files with bboxes of at most ' +
+                        'this many square degrees, like --chunk-size')
+    parser.add_argument('--upload', action='store_true',
+                        help='Upload changes to OSM API (see --osm-api), authorizing ' +
+                        'with an OAuth2 token from OSM_TOKEN environment variable')
+    parser.add_argument('--journal', default='upload.journal',
+                        help='File to record uploaded objects, to resume an interrupted upload '
+                        'of the same changes. It is removed after a successful upload')
+    parser.add_argument('--upload-batch', type=int, default=BATCH_SIZE,
+                        help='Number of objects in one diff upload')
     parser.add_argument('--osm',
                         help='Instead of querying Overpass API, use this unpacked osm file. ' +
                         'Create one from Overpass data if not found')
+    parser.add_argument('--snapshot',
+                        help='Use a local snapshot of OSM data instead of Overpass API. ' +
+                        'Create one from the --osm file (a planet extract) if not found')
+    parser.add_argument('--diffs',
+                        help='Directory with replication diffs to apply to the snapshot')
+    parser.add_argument('--backend', default='overpass',
+                        help='Where to get OSM data: "overpass" (default) or "local:<path>" ' +
+                        'for a snapshot, an OSM XML or a PBF file')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='Directory for caching Overpass API responses')
+    parser.add_argument('--cache-ttl', type=float, default=60,
+                        help='Time in minutes after which cached responses expire')
+    parser.add_argument('--cache-size', type=float, default=500,
+                        help='Maximum size of the response cache in megabytes')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not cache Overpass API responses')
+    parser.add_argument('--tiles', type=int, nargs='?', const=TILE_ZOOM,
+                        help='Cache OSM data in tiles of this zoom level (default {}), '
+                        'to reuse it for other profiles and regions'.format(TILE_ZOOM))
     parser.add_argument('-c', '--changes', type=argparse.FileType('w'),
                         help='Write changes as GeoJSON for visualization')
+    parser.add_argument('--changes-format', choices=FORMATS, default='pretty',
+                        help='Format of the changes file: an indented GeoJSON (default), ' +
+                        'a compact one, or newline-delimited GeoJSON features')
+    parser.add_argument('--changes-tiles',
+                        help='Write changes as vector tiles with a manifest into this directory')
+    parser.add_argument('--changes-zoom', type=int, nargs=2, default=[0, 14],
+                        metavar=('MIN', 'MAX'),
+                        help='Zoom levels for changes tiles, default 0 14')
     parser.add_argument('-m', '--check-move', action='store_true',
                         help='Check for moveability of modified modes')
     parser.add_argument('-f', '--for-filter', type=argparse.FileType('w'),
@@ -102,14 +150,23 @@ def run(profile=None):
                         help='Conflate only points with regions in this comma-separated list')
     parser.add_argument('--alt-overpass', action='store_true',
                         help='Use an alternate Overpass API server')
+    parser.add_argument('--overpass', action='append',
+                        help='Overpass API server URL, can be specified multiple times')
+    parser.add_argument('--osm-api',
+                        help='OSM API URL for checking moveability, e.g. of a local stand-in')
+    parser.add_argument('--hedge', type=float,
+                        help='Send a request to another server when the first one ' +
+                        'does not respond in this many seconds')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of parallel requests to Overpass API')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Display debug messages')
     parser.add_argument('-q', '--quiet', action='store_true',
                         help='Do not display informational messages')
     options = parser.parse_args()
 
-    if (not options.output and not options.changes and
-            not options.for_filter and not options.list):
+    if (not options.output and not options.changes and not options.changes_tiles and
+            not options.upload and not options.for_filter and not options.list):
         parser.print_help()
         return
 
@@ -152,31 +209,101 @@ def run(profile=None):
             logging.info('Prepared data for filtering, exitting')
         return
 
-    conflator = OsmConflator(profile, dataset, audit)
+    outputs = set()
+    if options.output or options.upload:
+        outputs.add('osc')
+    if options.changes or options.changes_tiles:
+        outputs.add('changes')
+    if options.list:
+        outputs.add('matches')
+    conflator = OsmConflator(profile, dataset, audit, outputs)
     conflator.geocoder = geocoder
-    if options.alt_overpass:
-        conflator.set_overpass('alt')
-    if options.osm and os.path.exists(options.osm):
-        with open(options.osm, 'r') as f:
-            conflator.parse_osm(f)
-    else:
+    if options.overpass:
+        conflator.set_overpass(options.overpass, options.hedge)
+    elif options.alt_overpass:
+        conflator.set_overpass('alt', options.hedge)
+    elif options.hedge:
+        conflator.set_overpass(
+            profile.get('overpass_servers', [OVERPASS_SERVER, ALT_OVERPASS_SERVER]), options.hedge)
+    conflator.downloader.threads = options.threads
+    write_changes = options.changes or options.changes_tiles
+    if write_changes and options.check_move:
+        conflator.downloader.parent_ways = True
+    if options.osm_api:
+        conflator.downloader.osm_api = options.osm_api
+    if options.backend.startswith('local:'):
+        snapshot = Snapshot.load(options.backend[len('local:'):])
+        conflator.downloader.backend = LocalBackend(snapshot)
+        conflator.downloader.snapshot = snapshot
+    elif options.backend != 'overpass':
+        parser.error('Unknown backend: {}'.format(options.backend))
+    if options.snapshot:
+        if os.path.exists(options.snapshot):
+            snapshot = Snapshot.load(options.snapshot)
+        elif options.osm:
+            if not os.path.exists(options.osm):
+                logging.error('OSM file %s for making the snapshot not found', options.osm)
+                sys.exit(2)
+            snapshot = Snapshot.load(options.osm)
+        else:
+            logging.error('Snapshot %s not found, specify an OSM file with --osm to create it',
+                          options.snapshot)
+            sys.exit(2)
+        if options.diffs:
+            snapshot.apply_diffs(options.diffs)
+        conflator.load_snapshot(snapshot)
+        if snapshot.changed:
+            snapshot.save(options.snapshot)
+    elif options.osm:
+        conflator.set_cache(OsmFileCache(options.osm))
+    elif not options.no_cache:
+        cache_ttl = int(options.cache_ttl * 60)
+        cache_size = int(options.cache_size * 1024 * 1024)
+        cache = ResponseCache(options.cache_dir, cache_ttl, cache_size)
+        conflator.set_cache(cache)
+        if options.tiles:
+            conflator.downloader.tile_cache = TileCache(zoom=options.tiles, parent=cache)
+    if options.tiles and (conflator.downloader.tile_cache is None or
+                          conflator.downloader.backend is not None):
+        logging.warning('Tiles are kept in the response cache, --tiles is ignored '
+                        'with --osm, --snapshot, --no-cache or a local backend')
+    if not options.snapshot:
         conflator.download_osm()
-        if len(conflator.osmdata) > 0 and options.osm:
-            with open(options.osm, 'w') as f:
-                f.write(conflator.backup_osm())
     logging.info('Downloaded %s objects from OSM', len(conflator.osmdata))
 
+    if write_changes:
+        conflator.changes_writer = ChangesWriter(
+            options.changes, options.changes_format, spool=options.check_move)
+    if options.changes_tiles:
+        tiles = TileBuilder(options.changes_tiles, *options.changes_zoom)
+        conflator.changes_writer.listeners.append(tiles.add)
     conflator.match()
 
-    if options.output:
-        diff = conflator.to_osc(not options.osc)
-        options.output.write(diff)
+    if options.output and (options.chunk_size or options.chunk_area):
+        filename = options.output.name if options.output.name[0] != '<' else 'changes'
+        chunks = conflator.write_chunks(
+            not options.osc, filename, options.chunk_size, options.chunk_area)
+        json.dump({'chunks': chunks}, options.output, indent=1)
+    elif options.output:
+        conflator.to_osc(not options.osc, options.output)
+
+    if options.upload:
+        uploader = Uploader(conflator.downloader.osm_api, os.environ.get('OSM_TOKEN'),
+                            conflator.get_changeset_tags(), options.journal, options.upload_batch)
+        try:
+            uploader.upload(conflator.matched)
+        except UploadError as e:
+            logging.error('%s', e)
+            sys.exit(2)
 
-    if options.changes:
+    if write_changes:
         if options.check_move:
+            # This also writes the spooled changes
             conflator.check_moveability()
-        fc = {'type': 'FeatureCollection', 'features': conflator.changes}
-        json.dump(fc, options.changes, ensure_ascii=False, sort_keys=True, indent=1)
+        else:
+            conflator.changes_writer.close()
+    if options.changes_tiles:
+        tiles.save()
 
     if options.list:
         writer = csv.writer(options.list)
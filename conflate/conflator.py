@@ -1,9 +1,11 @@
+import io
 import logging
+import os
 import kdtree
 from collections import defaultdict
-from .data import OSMPoint
+from .data import OSMPoint, ChangeRecord
 from .version import __version__
-from .osm import OsmDownloader, check_moveability
+from .osm import OsmDownloader
 from . import etree
 
 
@@ -13,19 +15,78 @@ LIFECYCLE_KEYS = set(('amenity', 'shop', 'tourism', 'craft', 'office'))
 LIFECYCLE_PREFIXES = ('proposed', 'construction', 'disused', 'abandoned', 'was', 'removed')
 
 
+def write_xml(fileobj, root, elements):
+    """Writes an XML document to a text file, serializing child elements
+    from an iterable one at a time after existing children of the root.
+    The result is the same as of serializing the whole tree."""
+    fileobj.write("<?xml version='1.0' encoding='utf-8'?>\n")
+    elements = iter(elements)
+    first = next(elements, None)
+    if first is None:
+        fileobj.write(etree.tostring(root, encoding='unicode'))
+        return
+    # Serializing the root with a marker child to split it into opening and closing parts
+    marker = etree.SubElement(root, 'marker')
+    head, tail = etree.tostring(root, encoding='unicode').split(
+        etree.tostring(marker, encoding='unicode'))
+    root.remove(marker)
+    fileobj.write(head)
+    fileobj.write(etree.tostring(first, encoding='unicode'))
+    for el in elements:
+        fileobj.write(etree.tostring(el, encoding='unicode'))
+    fileobj.write(tail)
+
+
+def hilbert_index(x, y, order=16):
+    """Returns a distance along the Hilbert curve for integer coordinates
+    in a square of 2**order cells."""
+    n = 1 << order
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
+def sort_by_hilbert(points):
+    """Sorts a list of points in place along a Hilbert curve, and returns it."""
+    points.sort(key=lambda p: hilbert_index(
+        int((p.lon + 180) / 360 * 0xFFFF), int((p.lat + 90) / 180 * 0xFFFF)))
+    return points
+
+
+OUTPUTS = frozenset(('osc', 'changes', 'matches'))
+
+
 class OsmConflator:
     """The main class for the conflator.
 
     It receives a dataset, after which one must call either
     "download_osm" or "parse_osm" methods. Then it is ready to match:
     call the "match" method and get results with "to_osc".
+
+    Outputs is a set of results that will be used: "osc" for OSM objects
+    (to_osc and uploads), "changes" for GeoJSON features and "matches" for the list
+    of matches. Other results are not built. By default, all of them are built.
     """
-    def __init__(self, profile, dataset, audit=None):
+    def __init__(self, profile, dataset, audit=None, outputs=None):
         self.dataset = {p.id: p for p in dataset}
         self.audit = audit or {}
+        self.outputs = outputs or OUTPUTS
         self.osmdata = {}
         self.matched = []
+        # ChangeRecords, see its "to_feature" method for GeoJSON
         self.changes = []
+        # When set, changes are written there instead of the list, see ChangesWriter
+        self.changes_writer = None
         self.matches = []
         self.profile = profile
         self.geocoder = None
@@ -39,12 +100,22 @@ class OsmConflator:
             self.ref = 'ref:' + self.profile.get(
                 'dataset_id', required='A fairly unique id of the dataset to query OSM')
 
-    def set_overpass(self, server='alt'):
-        self.downloader.set_overpass(server)
+    def set_overpass(self, server='alt', hedge_after=None):
+        self.downloader.set_overpass(server, hedge_after)
+
+    def set_cache(self, cache):
+        self.downloader.cache = cache
 
     def download_osm(self):
-        bboxes = self.downloader.calc_boxes(self.dataset.values())
-        self.osmdata = self.downloader.download(bboxes)
+        points = list(self.dataset.values())
+        bboxes = self.downloader.calc_boxes(points)
+        self.osmdata = self.downloader.download(bboxes, points)
+
+    def load_snapshot(self, snapshot):
+        """Takes OSM data from a local snapshot instead of downloading it."""
+        bboxes = self.downloader.calc_boxes(list(self.dataset.values()))
+        self.osmdata = snapshot.get_osmdata(self.downloader, bboxes)
+        self.downloader.snapshot = snapshot
 
     def parse_osm(self, fileobj):
         self.osmdata = self.downloader.parse_xml(fileobj)
@@ -109,67 +180,42 @@ class OsmConflator:
             return changed
 
         def format_change(before, after, ref):
-            MARKER_COLORS = {
-                'delete': '#ee2211',  # deleting feature from OSM
-                'create': '#11dd11',  # creating a new node
-                'update': '#0000ee',  # changing tags on an existing feature
-                'retag':  '#660000',  # cannot delete unmatched feature, changing tags
-                'move':   '#110055',  # moving an existing node
-            }
-            marker_action = None
-            geometry = {'type': 'Point', 'coordinates': [after.lon, after.lat]}
-            props = {
-                'osm_type': after.osm_type,
-                'osm_id': after.osm_id,
-                'action': after.action
-            }
+            change = ChangeRecord(after.osm_type, after.osm_id, after.action,
+                                  after.lat, after.lon, after.tags)
             if after.action in ('create', 'delete'):
                 # Red if deleted, green if added
-                marker_action = after.action
-                for k, v in after.tags.items():
-                    props['tags.{}'.format(k)] = v
+                change.marker = after.action
                 if ref:
-                    props['ref_id'] = ref.id
+                    change.ref_id = ref.id
             else:  # modified
                 # Blue if updated from dataset, dark red if retagged, dark blue if moved
-                marker_action = 'update' if ref else 'retag'
+                change.marker = 'update' if ref else 'retag'
+                change.old_tags = before.tags
                 if ref:
-                    props['ref_id'] = ref.id
-                    props['ref_distance'] = round(10 * ref.distance(before)) / 10.0
-                    props['ref_coords'] = [ref.lon, ref.lat]
+                    change.ref_id = ref.id
+                    change.ref_distance = round(10 * ref.distance(before)) / 10.0
+                    change.ref_coords = (ref.lon, ref.lat)
                     if before.lon != after.lon or before.lat != after.lat:
                         # The object was moved
-                        props['were_coords'] = [before.lon, before.lat]
-                        marker_action = 'move'
+                        change.were_coords = (before.lon, before.lat)
+                        change.marker = 'move'
                     # Find tags that were superseeded by OSM tags
                     for k, v in ref.tags.items():
                         osm_key = get_osm_key(k, after.tags)
                         if osm_key not in after.tags or after.tags[osm_key] != v:
-                            props['ref_unused_tags.{}'.format(osm_key)] = v
-                # Now compare old and new OSM tags
-                for k in set(after.tags.keys()).union(set(before.tags.keys())):
-                    v0 = before.tags.get(k, None)
-                    v1 = after.tags.get(k, None)
-                    if v0 == v1:
-                        props['tags.{}'.format(k)] = v0
-                    elif v0 is None:
-                        props['tags_new.{}'.format(k)] = v1
-                    elif v1 is None:
-                        props['tags_deleted.{}'.format(k)] = v0
-                    else:
-                        props['tags_changed.{}'.format(k)] = '{} -> {}'.format(v0, v1)
-            props['marker-color'] = MARKER_COLORS[marker_action]
+                            if change.unused_tags is None:
+                                change.unused_tags = {}
+                            change.unused_tags[osm_key] = v
             if ref and ref.remarks:
-                props['remarks'] = ref.remarks
+                change.remarks = ref.remarks
             if ref and ref.region:
-                props['region'] = ref.region
+                change.region = ref.region
             elif self.geocoder:
                 region, present = self.geocoder.find(after)
                 if not present:
                     return None
-                if region is not None:
-                    props['region'] = region
-            return {'type': 'Feature', 'geometry': geometry, 'properties': props}
+                change.region = region
+            return change
 
         p = self.osmdata.pop(osmdata_key, None)
         p0 = None if p is None else p.copy()
@@ -215,10 +261,11 @@ class OsmConflator:
                     p.lon = audit['move'][0]
                 if p.action is None and p0.distance(p) > 0.1:
                     p.action = 'modify'
-            if p.action != 'create':
-                self.matches.append([sp.id, p.osm_type, p.osm_id, p.lat, p.lon, p.action])
-            else:
-                self.matches.append([sp.id, '', '', p.lat, p.lon, p.action])
+            if 'matches' in self.outputs:
+                if p.action != 'create':
+                    self.matches.append([sp.id, p.osm_type, p.osm_id, p.lat, p.lon, p.action])
+                else:
+                    self.matches.append([sp.id, '', '', p.lat, p.lon, p.action])
         elif keep or p.is_area():
             if update_tags(p.tags, retag, retagging=True, audit=audit):
                 p.action = 'modify'
@@ -226,10 +273,19 @@ class OsmConflator:
             p.action = 'delete'
 
         if p.action is not None:
-            change = format_change(p0, p, sp)
-            if change is not None:
-                self.matched.append(p)
-                self.changes.append(change)
+            if 'changes' in self.outputs:
+                change = format_change(p0, p, sp)
+                if change is None:
+                    return
+                if self.changes_writer is not None:
+                    self.changes_writer.write(change.to_feature())
+                else:
+                    self.changes.append(change)
+            elif self.geocoder and self.geocoder.filter and not (sp and sp.region):
+                # Without changes, the geocoder is needed only for filtering regions
+                if not self.geocoder.find(p)[1]:
+                    return
+            self.matched.append(p)
 
     def match_dataset_points_smart(self):
         """Smart matching for dataset <-> OSM points.
@@ -402,44 +458,134 @@ class OsmConflator:
                 'Deleted %s and retagged %s unmatched objects from OSM',
                 count_deleted, count_retagged)
 
-    def backup_osm(self):
-        """Writes OSM data as-is."""
+        # Ways and relations need their members for writing changes
+        if 'osc' in self.outputs:
+            changed = self.downloader.fetch_members(self.matched)
+            if changed:
+                self.matched = [p for p in self.matched if p.id not in changed]
+
+    def get_changeset_tags(self):
+        return {
+            'source': self.source,
+            'created_by': TITLE,
+            'type': 'import'
+        }
+
+    def backup_osm(self, fileobj=None):
+        """Writes OSM data as-is to a text file, or returns it as a string."""
+        if fileobj is None:
+            fileobj = io.StringIO()
+            self.backup_osm(fileobj)
+            return fileobj.getvalue()
+
+        def elements():
+            for osmel in self.osmdata.values():
+                el = osmel.to_xml()
+                if osmel.osm_type != 'node':
+                    etree.SubElement(el, 'center', lat=str(osmel.lat), lon=str(osmel.lon))
+                yield el
+
         osm = etree.Element('osm', version='0.6', generator=TITLE)
-        for osmel in self.osmdata.values():
-            el = osmel.to_xml()
-            if osmel.osm_type != 'node':
-                etree.SubElement(el, 'center', lat=str(osmel.lat), lon=str(osmel.lon))
-            osm.append(el)
-        return ("<?xml version='1.0' encoding='utf-8'?>\n" +
-                etree.tostring(osm, encoding='utf-8').decode('utf-8'))
-
-    def to_osc(self, josm=False):
-        """Returns a string with osmChange or JOSM XML."""
+        write_xml(fileobj, osm, elements())
+
+    def to_osc(self, josm=False, fileobj=None, points=None):
+        """Writes osmChange or JOSM XML to a text file, one object at a time.
+        Returns a string with it when the file is not specified.
+        Writes only given points instead of all matched ones when specified,
+        numbering created objects from -1 in both formats."""
+        if fileobj is None:
+            fileobj = io.StringIO()
+            self.to_osc(josm, fileobj, points)
+            return fileobj.getvalue()
+
         osc = etree.Element('osm' if josm else 'osmChange', version='0.6', generator=TITLE)
         if josm:
-            neg_id = -1
             changeset = etree.SubElement(osc, 'changeset')
-            ch_tags = {
-                'source': self.source,
-                'created_by': TITLE,
-                'type': 'import'
-            }
-            for k, v in ch_tags.items():
+            for k, v in self.get_changeset_tags().items():
                 etree.SubElement(changeset, 'tag', k=k, v=v)
-        for osmel in self.matched:
-            if osmel.action is not None:
-                el = osmel.to_xml()
-                if josm:
-                    if osmel.action == 'create':
+
+        def elements():
+            neg_id = -1
+            for osmel in self.matched if points is None else points:
+                if osmel.action is not None:
+                    el = osmel.to_xml()
+                    if points is not None and not josm and osmel.action == 'create':
                         el.set('id', str(neg_id))
                         neg_id -= 1
+                    if josm:
+                        if osmel.action == 'create':
+                            el.set('id', str(neg_id))
+                            neg_id -= 1
+                        else:
+                            el.set('action', osmel.action)
+                        yield el
                     else:
-                        el.set('action', osmel.action)
-                    osc.append(el)
-                else:
-                    etree.SubElement(osc, osmel.action).append(el)
-        return ("<?xml version='1.0' encoding='utf-8'?>\n" +
-                etree.tostring(osc, encoding='utf-8').decode('utf-8'))
+                        action = etree.Element(osmel.action)
+                        action.append(el)
+                        yield action
+
+        write_xml(fileobj, osc, elements())
+
+    def write_chunks(self, josm, filename, max_elements=None, max_area=None):
+        """Writes changes into numbered files named after "filename", in chunks of
+        nearby objects: they are ordered along a Hilbert curve, and a chunk is closed
+        when it has "max_elements" objects, or when its bbox would exceed "max_area"
+        square degrees. Returns a list of dicts describing the chunks."""
+        points = sort_by_hilbert([p for p in self.matched if p.action is not None])
+        chunks = []
+        bbox = None
+        for p in points:
+            if bbox is not None:
+                new_bbox = [min(bbox[0], p.lat), min(bbox[1], p.lon),
+                            max(bbox[2], p.lat), max(bbox[3], p.lon)]
+                if ((max_elements and len(chunks[-1]) >= max_elements) or
+                        (max_area and (new_bbox[2] - new_bbox[0]) *
+                         (new_bbox[3] - new_bbox[1]) > max_area)):
+                    bbox = None
+            if bbox is None:
+                chunks.append([])
+                bbox = [p.lat, p.lon, p.lat, p.lon]
+            else:
+                bbox = new_bbox
+            chunks[-1].append(p)
+
+        base = os.path.splitext(filename)[0]
+        digits = len(str(len(chunks)))
+        index = []
+        for i, chunk in enumerate(chunks):
+            chunk_name = '{}-{:0{}d}{}'.format(base, i + 1, digits, '.osm' if josm else '.osc')
+            with open(chunk_name, 'w', encoding='utf-8') as f:
+                self.to_osc(josm, f, chunk)
+            actions = defaultdict(int)
+            for p in chunk:
+                actions[p.action] += 1
+            index.append({
+                'file': os.path.basename(chunk_name),
+                'elements': len(chunk),
+                'actions': dict(actions),
+                'bbox': [min(p.lat for p in chunk), min(p.lon for p in chunk),
+                         max(p.lat for p in chunk), max(p.lon for p in chunk)],
+            })
+        logging.info('Wrote %s changes in %s chunks', len(points), len(chunks))
+        return index
 
     def check_moveability(self):
-        check_moveability(self.changes)
+        """Sets "can_move" property for modified nodes in changes. For a streaming
+        changes writer, it should spool features, which are updated when it is closed."""
+        versions = {p.osm_id: p.version for p in self.matched if p.osm_type == 'node'}
+        if self.changes_writer is None:
+            self.downloader.check_moveability(self.changes, versions)
+            return
+
+        # Keeping only properties needed for the check
+        changes = [ChangeRecord(p['osm_type'], p['osm_id'], p['action'])
+                   for p in (f['properties'] for f in self.changes_writer.iter_spooled())]
+        self.downloader.check_moveability(changes, versions)
+        can_move = {c.osm_id: c.can_move for c in changes if c.can_move is not None}
+
+        def update(feature):
+            p = feature['properties']
+            if p['osm_type'] == 'node' and p['osm_id'] in can_move:
+                p['can_move'] = can_move[p['osm_id']]
+
+        self.changes_writer.close(update)
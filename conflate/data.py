@@ -74,6 +74,9 @@ class OSMPoint(SourcePoint):
     def is_poi(self):
         if self.osm_type == 'node':
             return True
+        if self.members is None:
+            # Deferred members: the query returned only closed ways and multipolygons
+            return self.osm_type == 'way' or self.tags.get('type', None) == 'multipolygon'
         if self.osm_type == 'way' and len(self.members) > 2:
             return self.members[0] == self.members[-1]
         if self.osm_type == 'relation' and len(self.members) > 0:
@@ -90,10 +93,10 @@ class OSMPoint(SourcePoint):
             el.set('lat', str(self.lat))
             el.set('lon', str(self.lon))
         elif self.osm_type == 'way':
-            for node_id in self.members:
+            for node_id in self.members or ():
                 etree.SubElement(el, 'nd', ref=str(node_id))
         elif self.osm_type == 'relation':
-            for member in self.members:
+            for member in self.members or ():
                 m = etree.SubElement(el, 'member')
                 for i, n in enumerate(('type', 'ref', 'role')):
                     m.set(n, str(member[i]))
@@ -102,3 +105,79 @@ class OSMPoint(SourcePoint):
     def __repr__(self):
         return 'OSMPoint({} {} v{}, {}, {}, action={}, tags={})'.format(
             self.osm_type, self.osm_id, self.version, self.lat, self.lon, self.action, self.tags)
+
+
+class ChangeRecord:
+    """A change of an OSM object for the GeoJSON output. Keeps references to tags
+    instead of formatted properties, which are produced by "to_feature"."""
+    MARKER_COLORS = {
+        'delete': '#ee2211',  # deleting feature from OSM
+        'create': '#11dd11',  # creating a new node
+        'update': '#0000ee',  # changing tags on an existing feature
+        'retag':  '#660000',  # cannot delete unmatched feature, changing tags
+        'move':   '#110055',  # moving an existing node
+    }
+    __slots__ = ('osm_type', 'osm_id', 'action', 'marker', 'lat', 'lon', 'tags', 'old_tags',
+                 'ref_id', 'ref_distance', 'ref_coords', 'were_coords', 'unused_tags',
+                 'remarks', 'region', 'can_move')
+
+    def __init__(self, osm_type, osm_id, action, lat=None, lon=None, tags=None):
+        self.osm_type = osm_type
+        self.osm_id = osm_id
+        self.action = action
+        self.marker = None
+        self.lat = lat
+        self.lon = lon
+        self.tags = tags
+        # Tags before the change, for modified objects only
+        self.old_tags = None
+        self.ref_id = None
+        self.ref_distance = None
+        self.ref_coords = None
+        self.were_coords = None
+        self.unused_tags = None
+        self.remarks = None
+        self.region = None
+        self.can_move = None
+
+    def to_feature(self):
+        """Returns a GeoJSON feature with the change."""
+        props = {
+            'osm_type': self.osm_type,
+            'osm_id': self.osm_id,
+            'action': self.action
+        }
+        if self.old_tags is None:
+            for k, v in self.tags.items():
+                props['tags.{}'.format(k)] = v
+            if self.ref_id is not None:
+                props['ref_id'] = self.ref_id
+        else:
+            if self.ref_id is not None:
+                props['ref_id'] = self.ref_id
+                props['ref_distance'] = self.ref_distance
+                props['ref_coords'] = list(self.ref_coords)
+                if self.were_coords is not None:
+                    props['were_coords'] = list(self.were_coords)
+                for k, v in (self.unused_tags or {}).items():
+                    props['ref_unused_tags.{}'.format(k)] = v
+            for k in set(self.tags.keys()).union(set(self.old_tags.keys())):
+                v0 = self.old_tags.get(k, None)
+                v1 = self.tags.get(k, None)
+                if v0 == v1:
+                    props['tags.{}'.format(k)] = v0
+                elif v0 is None:
+                    props['tags_new.{}'.format(k)] = v1
+                elif v1 is None:
+                    props['tags_deleted.{}'.format(k)] = v0
+                else:
+                    props['tags_changed.{}'.format(k)] = '{} -> {}'.format(v0, v1)
+        props['marker-color'] = self.MARKER_COLORS[self.marker]
+        if self.remarks:
+            props['remarks'] = self.remarks
+        if self.region is not None:
+            props['region'] = self.region
+        if self.can_move is not None:
+            props['can_move'] = self.can_move
+        return {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [
+            self.lon, self.lat]}, 'properties': props}
@@ -1,64 +1,314 @@
 import logging
 import json
 import codecs
+import csv
+import bz2
+import gzip
+import io
+import functools
+import itertools
+import lzma
+import multiprocessing
+import re
 import requests
-import kdtree
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 from .data import SourcePoint
+from .duplicates import SelfJoin, group_pairs
 
 
-def read_dataset(profile, fileobj):
-    """A helper function to call a "dataset" function in the profile.
-    If the fileobj is not specified, tries to download a dataset from
-    an URL specified in "download_url" profile variable."""
+CHUNK_SIZE = 1024 * 1024  # characters read from a JSON source at once
+CSV_BATCH = 10000  # rows converted at once
+CSV_CHUNK = 4 * 1024 * 1024  # characters of CSV lines sent to a worker process
+TRANSFORM_CHUNK = 10000  # points transformed in a worker process at once
+WHITESPACE = re.compile(r'[\s\x1e]*')  # including record separators of GeoJSONSeq
+
+
+def open_compressed(fileobj):
+    """Returns a file object that decompresses gzip, bzip2 or xz data,
+    judging by the first bytes, or the same file object for other data."""
+    if not hasattr(fileobj, 'peek'):
+        fileobj = io.BufferedReader(fileobj)
+    magic = fileobj.peek(6)[:6]
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=fileobj)
+    if magic[:3] == b'BZh':
+        return bz2.BZ2File(fileobj)
+    if magic == b'\xfd7zXZ\x00':
+        return lzma.LZMAFile(fileobj)
+    return fileobj
+
+
+class JsonStream:
+    """Decodes JSON values one by one from a text file,
+    keeping in memory only a chunk of it."""
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Reads the next chunk. Returns False at the end of the file."""
+        chunk = self.fileobj.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character, or '' at the end."""
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected "{}" in JSON, got "{}"'.format(char, self.peek()))
+        self.pos += 1
+
+    def value(self):
+        """Decodes the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number at the end of the buffer might continue in the next chunk
+            if end < len(self.buf) or not self.fill():
+                self.pos = end
+                return value
+
+    def array(self):
+        """Yields values from an array."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            c = self.peek()
+            self.pos += 1
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError('Expected "," or "]" in JSON array, got "{}"'.format(c))
+
+
+def iter_json(fileobj):
+    """Yields items from a JSON source: features of a GeoJSON FeatureCollection,
+    elements of an array, or objects of a sequence like JSON Lines or GeoJSONSeq.
+    The source can be compressed with gzip, bzip2 or xz."""
+    stream = JsonStream(codecs.getreader('utf-8')(open_compressed(fileobj)))
+    first = stream.peek()
+    if first == '[':
+        yield from stream.array()
+    elif first == '{':
+        # Reading keys of the object until we find "features"
+        stream.pos += 1
+        obj = {}
+        has_features = False
+        while stream.peek() != '}':
+            if obj or has_features:
+                stream.expect(',')
+            key = stream.value()
+            stream.expect(':')
+            if key == 'features' and stream.peek() == '[':
+                yield from stream.array()
+                has_features = True
+            else:
+                obj[key] = stream.value()
+        stream.pos += 1
+        if not has_features:
+            yield obj
+            while stream.peek():
+                yield stream.value()
+    elif first:
+        raise ValueError('A JSON source should start with "[" or "{{", got "{}"'.format(first))
+
+
+def json_to_point(item):
+    """Makes a SourcePoint from a GeoJSON feature or an object with "id",
+    "lat", "lon" and "tags" keys. Returns None for features that are skipped."""
+    if 'geometry' not in item:
+        return SourcePoint(item['id'], item['lat'], item['lon'], item['tags'])
+    if not item['geometry'] or item['geometry'].get('type') != 'Point' or (
+            'properties' not in item):
+        return None
+    # Get the identifier from "id", "ref", "ref*"
+    iid = item['properties'].get('id', item['properties'].get('ref'))
+    if not iid:
+        for k, v in item['properties'].items():
+            if k.startswith('ref'):
+                iid = v
+                break
+    if not iid:
+        return None
+    return SourcePoint(
+        iid,
+        item['geometry']['coordinates'][1],
+        item['geometry']['coordinates'][0],
+        {k: v for k, v in item['properties'].items() if k != 'id'})
+
+
+def parse_csv_rows(mapping, rows):
+    """Converts CSV rows to tuples of (id, lat, lon, tags, remarks) using
+    a mapping from "iter_csv". Returns a list of tuples and a number of skipped rows."""
+    id_col, lat_col, lon_col, tag_cols, remarks_col = mapping
+    records = []
+    skipped = 0
+    for row in rows:
+        try:
+            pid = row[id_col]
+            lat = float(row[lat_col])
+            lon = float(row[lon_col])
+        except (IndexError, ValueError):
+            skipped += 1
+            continue
+        if not pid:
+            skipped += 1
+            continue
+        # Empty cells mean no tag
+        tags = {k: row[i] for k, i in tag_cols if i < len(row) and row[i]}
+        remarks = None
+        if remarks_col is not None and remarks_col < len(row):
+            remarks = row[remarks_col] or None
+        records.append((pid, lat, lon, tags, remarks))
+    return records, skipped
+
+
+def parse_csv_lines(mapping, delimiter, lines):
+    """Parses a chunk of CSV lines in a worker process."""
+    return parse_csv_rows(mapping, csv.reader(lines, delimiter=delimiter))
+
+
+def iter_csv(fileobj, source_format):
+    """Yields SourcePoints from a CSV or TSV source, as described in the "source_format"
+    profile variable. For example:
+
+        source_format = {
+            'type': 'csv',  # or 'tsv'
+            'id': 'ID', 'lat': 'Latitude', 'lon': 'Longitude',
+            'tags': {'name': 'Title', 'opening_hours': 'Hours'},
+            'remarks': 'Comment',  # optional
+        }
+
+    Columns are referenced by names from the header, or by numbers from 0 when
+    "header" is False. Other keys are "delimiter", "encoding" (utf-8 by default),
+    and "processes" for parsing chunks of the file in a process pool.
+    With processes, values cannot contain line breaks.
+    """
+    delimiter = source_format.get('delimiter', '\t' if source_format['type'] == 'tsv' else ',')
+    f = io.TextIOWrapper(open_compressed(fileobj),
+                         encoding=source_format.get('encoding', 'utf-8'), newline='')
+    header = None
+    if source_format.get('header', True):
+        header = next(csv.reader([f.readline()], delimiter=delimiter), [])
+
+    def column(name):
+        if isinstance(name, int):
+            return name
+        if header is None or name not in header:
+            raise ValueError('Column "{}" is missing in the source'.format(name))
+        return header.index(name)
+
+    remarks = source_format.get('remarks')
+    mapping = (column(source_format['id']), column(source_format['lat']),
+               column(source_format['lon']),
+               [(k, column(v)) for k, v in source_format.get('tags', {}).items()],
+               None if remarks is None else column(remarks))
+
+    processes = source_format.get('processes', 1)
+    if processes > 1:
+        results = map_chunks(functools.partial(parse_csv_lines, mapping, delimiter),
+                             iter(lambda: f.readlines(CSV_CHUNK), []), processes)
+    else:
+        reader = csv.reader(f, delimiter=delimiter)
+        results = iter(lambda: parse_csv_rows(mapping, itertools.islice(reader, CSV_BATCH)),
+                       ([], 0))
+    skipped = 0
+    for records, batch_skipped in results:
+        skipped += batch_skipped
+        for pid, lat, lon, tags, remarks in records:
+            yield SourcePoint(pid, lat, lon, tags, remarks=remarks)
+    if skipped:
+        logging.warning('Skipped %s rows without an id or coordinates', skipped)
+
+
+def map_chunks(fn, chunks, processes, mp_context=None):
+    """Yields results of fn for every chunk in order, calling it in a process pool
+    and keeping only a few chunks in memory."""
+    with ProcessPoolExecutor(processes, mp_context=mp_context) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(fn, chunk))
+            if len(pending) >= processes * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_dataset(profile, fileobj):
+    """Yields SourcePoints from the "dataset" function in the profile, or else
+    from a CSV source (see iter_csv) or a JSON source (see iter_json).
+    If the fileobj is not specified, tries to download a dataset from an URL
+    specified in "download_url" profile variable."""
     if not fileobj:
         url = profile.get('download_url')
         if url is None:
             logging.error('No download_url specified in the profile, '
                           'please provide a dataset file with --source')
-            return None
-        r = requests.get(url)
+            return
+        # Profiles might need to seek in the source, so it is streamed only for built-in readers
+        stream = not profile.has('dataset')
+        r = requests.get(url, stream=stream)
         if r.status_code != 200:
             logging.error('Could not download source data: %s %s', r.status_code, r.text)
-            return None
-        if len(r.content) == 0:
+            return
+        if stream:
+            r.raw.decode_content = True
+            # Otherwise it is closed at the end before a buffered reader gets there
+            r.raw.auto_close = False
+            fileobj = r.raw
+        elif len(r.content) == 0:
             logging.error('Empty response from %s', url)
-            return None
-        fileobj = BytesIO(r.content)
+            return
+        else:
+            fileobj = BytesIO(r.content)
+    source_format = profile.get('source_format')
+    if not profile.has('dataset') and source_format and source_format.get('type') in (
+            'csv', 'tsv'):
+        yield from iter_csv(fileobj, source_format)
+        return
     if not profile.has('dataset'):
         # The default option is to parse the source as a JSON
         try:
-            data = []
-            reader = codecs.getreader('utf-8')
-            json_src = json.load(reader(fileobj))
-            if 'features' in json_src:
-                # Parse GeoJSON
-                for item in json_src['features']:
-                    if item['geometry'].get('type') != 'Point' or 'properties' not in item:
-                        continue
-                    # Get the identifier from "id", "ref", "ref*"
-                    iid = item['properties'].get('id', item['properties'].get('ref'))
-                    if not iid:
-                        for k, v in item['properties'].items():
-                            if k.startswith('ref'):
-                                iid = v
-                                break
-                    if not iid:
-                        continue
-                    data.append(SourcePoint(
-                        iid,
-                        item['geometry']['coordinates'][1],
-                        item['geometry']['coordinates'][0],
-                        {k: v for k, v in item['properties'].items() if k != 'id'}))
-            else:
-                for item in json_src:
-                    data.append(SourcePoint(item['id'], item['lat'], item['lon'], item['tags']))
-            return data
+            for item in iter_json(fileobj):
+                point = json_to_point(item)
+                if point is not None:
+                    yield point
+            return
         except Exception:
             logging.error('Failed to parse the source as a JSON')
-    return list(profile.get(
+    yield from profile.get(
         'dataset', args=(fileobj,),
-        required='returns a list of SourcePoints with the dataset'))
+        required='returns a list of SourcePoints with the dataset')
+
+
+def read_dataset(profile, fileobj):
+    """Returns a list of SourcePoints, see iter_dataset."""
+    return list(iter_dataset(profile, fileobj))
 
 
 def add_categories_to_dataset(profile, dataset):
@@ -77,73 +327,127 @@ def add_categories_to_dataset(profile, dataset):
                 d.tags.update(cat_tags)
 
 
-def transform_dataset(profile, dataset):
-    """Transforms tags in the dataset using the "transform" method in the profile
-    or the instructions in that field in string or dict form."""
-    transform = profile.get_raw('transform')
+def compile_rule(key, rules):
+    """Returns a function that changes a dict of tags according to
+    the rules for the key from the "transform" profile variable."""
+    if callable(rules):
+        # The value can be generated
+        def generate(tags):
+            value = rules(None if key not in tags else tags[key])
+            if value is not None:
+                tags[key] = value
+            elif key in tags:
+                del tags[key]
+        return generate
+
+    first = rules[0]
+    lower = isinstance(rules, list) and 'lower' in rules[1:]
+    if first and isinstance(first, str) and first[0] == '>':
+        # Replace the key
+        new_key = first[1:]
+
+        def rename(tags):
+            if key in tags:
+                tags[new_key] = tags[key]
+                del tags[key]
+        return rename
+    if first and isinstance(first, str) and first[0] == '<':
+        # Replace the key, the same but backwards
+        alt_key = first[1:]
+
+        def rename_back(tags):
+            if alt_key in tags:
+                tags[key] = tags[alt_key]
+                del tags[alt_key]
+        return rename_back
+    if first == '-':
+        # Delete the tag
+        def delete(tags):
+            if key in tags:
+                del tags[key]
+        return delete
+
+    if not first or (isinstance(first, str) and first[0] == '.'):
+        # Use the value of the tag, or of another tag
+        source = first[1:] if first else key
+
+        def copy(tags):
+            if source in tags:
+                tags[key] = tags[source].lower() if lower else tags[source]
+        return copy
+
+    # Take the value as written, converting it to a string if needed
+    value = first if isinstance(first, str) else str(first)
+    if lower:
+        value = value.lower()
+
+    def assign(tags):
+        tags[key] = value
+    return assign
+
+
+def compile_transform(transform):
+    """Returns a list of functions to be applied to a dict of tags in order,
+    for the "transform" profile variable, or None if there is nothing to do."""
     if not transform:
-        return
+        return None
     if callable(transform):
-        for d in dataset:
-            transform(d.tags)
-        return
+        return [transform]
     if isinstance(transform, str):
         # Convert string of "key=value|rule1|rule2" lines to a dict
         lines = [line.split('=', 1) for line in transform.splitlines()]
         transform = {l[0].strip(): l[1].strip() for l in lines}
     if not transform or not isinstance(transform, dict):
-        return
+        return None
     for key in transform:
         if isinstance(transform[key], str):
             transform[key] = [x.strip() for x in transform[key].split('|')]
+    return [compile_rule(key, rules) for key, rules in transform.items() if rules]
+
+
+# Transform functions for worker processes, which get them by forking
+_transform_ops = None
+
+
+def transform_tags(chunk):
+    """Applies transform functions to a list of tag dicts in a worker process."""
+    for tags in chunk:
+        for op in _transform_ops:
+            op(tags)
+    return chunk
+
+
+def transform_dataset(profile, dataset):
+    """Transforms tags in the dataset using the "transform" method in the profile
+    or the instructions in that field in string or dict form. Rules are compiled
+    into functions once. With "transform_processes" profile variable, the dataset
+    is transformed in chunks in a process pool: use it for slow transform functions
+    that do not depend on other points."""
+    global _transform_ops
+    ops = compile_transform(profile.get_raw('transform'))
+    if not ops:
+        return
+    processes = profile.get('transform_processes', 1)
+    if processes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        logging.warning('Cannot pass transform functions to processes, using one')
+        processes = 1
+    if processes > 1:
+        _transform_ops = ops
+        try:
+            chunks = [dataset[i:i+TRANSFORM_CHUNK]
+                      for i in range(0, len(dataset), TRANSFORM_CHUNK)]
+            results = map_chunks(transform_tags, ([d.tags for d in chunk] for chunk in chunks),
+                                 processes, multiprocessing.get_context('fork'))
+            for tags, chunk in zip(results, chunks):
+                for d, t in zip(chunk, tags):
+                    d.tags = t
+        finally:
+            _transform_ops = None
+        return
 
     for d in dataset:
-        for key, rules in transform.items():
-            if not rules:
-                continue
-            value = None
-            if callable(rules):
-                # The value can be generated
-                value = rules(None if key not in d.tags else d.tags[key])
-                if value is None and key in d.tags:
-                    del d.tags[key]
-            elif not rules[0]:
-                # Use the value of the tag
-                if key in d.tags:
-                    value = d.tags[key]
-            elif not isinstance(rules[0], str):
-                # If the value is not a string, use it
-                value = str(rules[0])
-            elif rules[0][0] == '.':
-                # Use the value from another tag
-                alt_key = rules[0][1:]
-                if alt_key in d.tags:
-                    value = d.tags[alt_key]
-            elif rules[0][0] == '>':
-                # Replace the key
-                if key in d.tags:
-                    d.tags[rules[0][1:]] = d.tags[key]
-                    del d.tags[key]
-            elif rules[0][0] == '<':
-                # Replace the key, the same but backwards
-                alt_key = rules[0][1:]
-                if alt_key in d.tags:
-                    d.tags[key] = d.tags[alt_key]
-                    del d.tags[alt_key]
-            elif rules[0] == '-':
-                # Delete the tag
-                if key in d.tags:
-                    del d.tags[key]
-            else:
-                # Take the value as written
-                value = rules[0]
-            if value is None:
-                continue
-            if isinstance(rules, list):
-                for rule in rules[1:]:
-                    if rule == 'lower':
-                        value = value.lower()
-            d.tags[key] = value
+        for op in ops:
+            op(d.tags)
 
 
 def check_dataset_for_duplicates(profile, dataset, print_all=False):
@@ -165,35 +469,20 @@ def check_dataset_for_duplicates(profile, dataset, print_all=False):
     # And then for near-duplicate points with similar tags
     uncond_distance = profile.get('duplicate_distance', 1)
     diff_tags = [k for k in tags if tags[k] == '---']
-    kd = kdtree.create(list(dataset))
-    duplicates = set()
-    group = 0
-    for d in dataset:
-        if d.id in duplicates:
-            continue
-        group += 1
-        dups = kd.search_knn(d, 2)  # The first one will be equal to d
-        if len(dups) < 2 or dups[1][0].data.distance(d) > profile.max_distance:
-            continue
-        for alt, _ in kd.search_knn(d, 20):
-            dist = alt.data.distance(d)
-            if alt.data.id != d.id and dist <= profile.max_distance:
-                tags_differ = 0
-                if dist > uncond_distance:
-                    for k in diff_tags:
-                        if alt.data.tags.get(k) != d.tags.get(k):
-                            tags_differ += 1
-                if tags_differ <= len(diff_tags) / 3:
-                    duplicates.add(alt.data.id)
-                    d.exclusive_group = group
-                    alt.data.exclusive_group = group
-                    if print_all or len(duplicates) <= 5:
-                        is_duplicate = tags_differ <= 1
-                        logging.error('Dataset points %s: %s and %s',
-                                      'duplicate each other' if is_duplicate else 'are too similar',
-                                      d.id, alt.data.id)
+    join = SelfJoin(dataset, profile.max_distance, uncond_distance, diff_tags)
+    pairs = join.find_all_pairs(profile.get('duplicate_processes', 1))
+    groups = group_pairs(pairs)
+    for i, group in groups.items():
+        dataset[i].exclusive_group = group
+    for n, (i, j, tags_differ) in enumerate(pairs):
+        if print_all or n < 5:
+            is_duplicate = tags_differ <= 1
+            logging.error('Dataset points %s: %s and %s',
+                          'duplicate each other' if is_duplicate else 'are too similar',
+                          dataset[i].id, dataset[j].id)
+    duplicates = len(groups) - len(set(groups.values()))
     if duplicates:
-        logging.error('Found %s duplicates in the dataset', len(duplicates))
+        logging.error('Found %s duplicates in the dataset', duplicates)
     if found_duplicate_ids:
         raise KeyError('Cannot continue with duplicate ids')
 
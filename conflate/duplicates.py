@@ -0,0 +1,151 @@
+import math
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+EARTH_RADIUS = 6378137  # in meters, as in SourcePoint.distance
+STRIPE_ROWS = 16  # grid rows compared in one task of a process pool
+
+
+class SelfJoin:
+    """Finds pairs of similar points in a list, which are closer than max_distance meters.
+
+    Points are put into grid rows of max_distance height, and cells in each row
+    are max_distance wide at the latitude farthest from the equator in the row
+    and its neighbours. So every point is compared only with points in its cell,
+    in adjacent cells, and in the next row. Points closer than uncond_distance
+    are always similar, others when no more than a third of diff_tags differ.
+    """
+    def __init__(self, points, max_distance, uncond_distance=1, diff_tags=()):
+        self.points = points
+        self.max_distance = max_distance
+        self.uncond_distance = uncond_distance
+        self.max_differ = len(diff_tags) / 3
+        self.height = math.degrees(max_distance / EARTH_RADIUS)
+        # Tag values are replaced with numbers for comparing, with 0 for missing tags
+        values = {None: 0}
+        self.codes = [tuple(values.setdefault(p.tags.get(k), len(values)) for k in diff_tags)
+                      for p in points]
+        if numpy is not None:
+            self.codes = numpy.array(self.codes, dtype=numpy.int32).reshape(
+                len(points), len(diff_tags))
+
+        rows = defaultdict(list)
+        for i, p in enumerate(points):
+            rows[math.floor(p.lat / self.height)].append(i)
+        self.widths = {}
+        self.cells = {}
+        for y, row in rows.items():
+            width = self.widths[y] = self.get_width(y)
+            cells = self.cells[y] = defaultdict(list)
+            for i in row:
+                cells[math.floor(points[i].lon / width)].append(i)
+
+    def get_width(self, y):
+        """Returns the width of cells in a row, in degrees."""
+        lat = min(90, max(abs(y - 1), abs(y + 2)) * self.height)
+        return self.height / max(math.cos(math.radians(lat)), 0.01)
+
+    def find_pairs(self, rows):
+        """Returns a list of (i, j, number of different tags) for similar points
+        with i < j, where one of the points is in the rows."""
+        points = self.points
+        first = []
+        second = []
+        distances = []
+        for y in rows:
+            width = self.widths[y]
+            cells = self.cells[y]
+            next_cells = self.cells.get(y + 1, {})
+            next_width = self.widths.get(y + 1, width)
+            for x, cell in cells.items():
+                for i in cell:
+                    p = points[i]
+                    candidates = [j for cx in (x - 1, x, x + 1)
+                                  for j in cells.get(cx, ()) if j > i]
+                    for cx in range(math.floor((p.lon - width) / next_width),
+                                    math.floor((p.lon + width) / next_width) + 1):
+                        candidates.extend(next_cells.get(cx, ()))
+                    for j in candidates:
+                        dist = p.distance(points[j])
+                        if dist <= self.max_distance:
+                            first.append(min(i, j))
+                            second.append(max(i, j))
+                            distances.append(dist)
+        if not first:
+            return []
+
+        if numpy is not None:
+            first = numpy.array(first)
+            second = numpy.array(second)
+            differ = (self.codes[first] != self.codes[second]).sum(axis=1)
+            differ[numpy.array(distances) <= self.uncond_distance] = 0
+            similar = differ <= self.max_differ
+            return list(zip(first[similar].tolist(), second[similar].tolist(),
+                            differ[similar].tolist()))
+
+        result = []
+        for i, j, dist in zip(first, second, distances):
+            differ = 0
+            if dist > self.uncond_distance:
+                differ = sum(1 for a, b in zip(self.codes[i], self.codes[j]) if a != b)
+            if differ <= self.max_differ:
+                result.append((i, j, differ))
+        return result
+
+    def find_all_pairs(self, processes=1):
+        """Returns a sorted list of all pairs from "find_pairs". With processes,
+        stripes of grid rows are processed in a process pool."""
+        global _self_join
+        rows = sorted(self.cells)
+        stripes = [rows[i:i+STRIPE_ROWS] for i in range(0, len(rows), STRIPE_ROWS)]
+        if processes > 1 and len(stripes) > 1 and (
+                'fork' in multiprocessing.get_all_start_methods()):
+            # Workers get the index by forking
+            _self_join = self
+            try:
+                with ProcessPoolExecutor(
+                        processes, mp_context=multiprocessing.get_context('fork')) as executor:
+                    results = list(executor.map(find_stripe_pairs, stripes))
+            finally:
+                _self_join = None
+        else:
+            results = [self.find_pairs(stripe) for stripe in stripes]
+        return sorted(pair for pairs in results for pair in pairs)
+
+
+# SelfJoin instance for worker processes
+_self_join = None
+
+
+def find_stripe_pairs(rows):
+    return _self_join.find_pairs(rows)
+
+
+def group_pairs(pairs):
+    """Merges pairs of indices into groups. Returns a dict of index -> group number,
+    with groups numbered from 1 in order of their smallest indices."""
+    parent = {}
+
+    def find(i):
+        root = i
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while i != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for i, j, _ in pairs:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    groups = {}
+    numbers = {}
+    for i in sorted(parent.keys() | {i for i, _, _ in pairs}):
+        groups[i] = numbers.setdefault(find(i), len(numbers) + 1)
+    return groups
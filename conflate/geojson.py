@@ -0,0 +1,78 @@
+import json
+import tempfile
+
+
+FORMATS = ('pretty', 'compact', 'ndjson')
+
+
+class ChangesWriter:
+    """Writes GeoJSON features to a text file as they come.
+
+    Formats are "pretty" for a FeatureCollection indented like json.dump with indent=1,
+    "compact" for a FeatureCollection in a single line, and "ndjson" for one feature
+    per line. With spool=True, features are kept in a temporary file
+    until "close" is called, so they can be updated in a post-pass.
+    Functions in "listeners" are called with every final feature, and with
+    fileobj=None, features are only passed to them.
+    """
+    def __init__(self, fileobj, fmt='pretty', spool=False):
+        if fmt not in FORMATS:
+            raise ValueError('Unknown GeoJSON format: {}'.format(fmt))
+        self.fileobj = fileobj
+        self.fmt = fmt
+        self.count = 0
+        self.listeners = []
+        self.spool = None
+        if spool:
+            self.spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+
+    def write(self, feature):
+        if self.spool is not None:
+            self.spool.write(json.dumps(feature, ensure_ascii=False) + '\n')
+        else:
+            self.write_feature(feature)
+
+    def write_feature(self, feature):
+        for listener in self.listeners:
+            listener(feature)
+        f = self.fileobj
+        if f is None:
+            return
+        if self.fmt == 'ndjson':
+            f.write(json.dumps(feature, ensure_ascii=False, sort_keys=True))
+            f.write('\n')
+        elif self.fmt == 'compact':
+            f.write(',' if self.count else '{"features":[')
+            f.write(json.dumps(feature, ensure_ascii=False, sort_keys=True,
+                               separators=(',', ':')))
+        else:
+            f.write(',\n  ' if self.count else '{\n "features": [\n  ')
+            # Strings in JSON cannot contain line breaks, so we can indent lines
+            f.write(json.dumps(feature, ensure_ascii=False, sort_keys=True,
+                               indent=1).replace('\n', '\n  '))
+        self.count += 1
+
+    def iter_spooled(self):
+        """Yields features written so far into the spool."""
+        self.spool.seek(0)
+        for line in self.spool:
+            yield json.loads(line)
+
+    def close(self, update=None):
+        """Writes spooled features, calling "update" for each of them if specified,
+        and finishes the FeatureCollection."""
+        if self.spool is not None:
+            for feature in self.iter_spooled():
+                if update is not None:
+                    update(feature)
+                self.write_feature(feature)
+            self.spool.close()
+            self.spool = None
+        if self.fileobj is None:
+            return
+        if self.fmt == 'compact':
+            self.fileobj.write('],"type":"FeatureCollection"}' if self.count
+                               else '{"features":[],"type":"FeatureCollection"}')
+        elif self.fmt == 'pretty':
+            self.fileobj.write('\n ],\n "type": "FeatureCollection"\n}' if self.count
+                               else '{\n "features": [],\n "type": "FeatureCollection"\n}')
@@ -0,0 +1,142 @@
+import logging
+import math
+import re
+from collections import defaultdict
+
+
+GRID_SIZE = 0.05  # in degrees, ~5 km
+
+
+class LocalBackend:
+    """Answers OsmDownloader queries from a local snapshot (see Snapshot)
+    instead of Overpass API.
+
+    Tagged objects are indexed by grid cells covering their extents, and by their
+    tag keys. Every clause of the profile query looks only at objects which have
+    its rarest required key, or which lie in its bbox, whichever is fewer.
+    Area filters from "query_footprint" are not applied: bboxes are used instead.
+    """
+    def __init__(self, snapshot, grid_size=GRID_SIZE):
+        self.snapshot = snapshot
+        self.grid_size = grid_size
+        self.cells = defaultdict(list)
+        self.keys = defaultdict(set)
+        self.extents = {}
+        for key, record in snapshot.objects.items():
+            if not record[5]:
+                # Untagged ways are kept only for finding relation centers
+                continue
+            extent = self.get_extent(record)
+            self.extents[key] = extent
+            for cell in self.cells_for_bbox(extent):
+                self.cells[cell].append(key)
+            for k in record[5]:
+                self.keys[k].add(key)
+        logging.info('Indexed %s objects in %s cells', len(self.extents), len(self.cells))
+
+    def get_extent(self, record):
+        """Returns [min_lat, min_lon, max_lat, max_lon] for a way from its nodes,
+        or a bbox of the center point for other objects."""
+        extent = [record[3], record[4], record[3], record[4]]
+        if record[0] == 'way' and record[6]:
+            coords = [self.snapshot.nodes.get(int(ref)) for ref in record[6]]
+            if None not in coords:
+                extent = [min(c[0] for c in coords), min(c[1] for c in coords),
+                          max(c[0] for c in coords), max(c[1] for c in coords)]
+        return extent
+
+    def cell_range(self, bbox):
+        g = self.grid_size
+        return (math.floor(bbox[0] / g), math.floor(bbox[1] / g),
+                math.floor(bbox[2] / g), math.floor(bbox[3] / g))
+
+    def cells_for_bbox(self, bbox):
+        y0, x0, y1, x1 = self.cell_range(bbox)
+        return [(y, x) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    def intersects(self, key, bbox):
+        extent = self.extents[key]
+        return (extent[0] <= bbox[2] and bbox[0] <= extent[2] and
+                extent[1] <= bbox[3] and bbox[1] <= extent[3])
+
+    def get_filters(self, profile):
+        """Returns the "query" list of the profile as a list of clauses,
+        each being a list of tag tuples."""
+        tags = profile.get(
+            'query', required="a list of tuples. E.g. [('amenity', 'cafe'), ('name', '~Mc.*lds')]")
+        if isinstance(tags, str):
+            raise ValueError('Cannot evaluate an Overpass API query string locally')
+        if not isinstance(tags[0], str) and isinstance(tags[0][0], str):
+            tags = [tags]
+        for tags_q in tags:
+            if isinstance(tags_q, str):
+                raise ValueError('Cannot evaluate an Overpass API query string locally')
+        return tags
+
+    @staticmethod
+    def match(tags_q, tags):
+        """Checks tags against a query clause, like Overpass API
+        does with a filter from OsmDownloader.get_tag_strings."""
+        for t in tags_q:
+            value = tags.get(t[0])
+            if len(t) == 1:
+                if value is None:
+                    return False
+            elif t[1] is None or len(t[1]) == 0:
+                if value is not None:
+                    return False
+            elif value is None:
+                return False
+            elif t[1][0] == '~':
+                if not re.search(t[1][1:], value, re.I):
+                    return False
+            elif value not in t[1:]:
+                return False
+        return True
+
+    def find(self, tags_q, bbox):
+        """Returns a set of keys of objects matching a clause in a bbox (None for all)."""
+        required = [t[0] for t in tags_q if len(t) == 1 or t[1]]
+        if required:
+            candidates = min((self.keys.get(k, ()) for k in required), key=len)
+        else:
+            candidates = self.extents.keys()
+        if bbox is not None:
+            y0, x0, y1, x1 = self.cell_range(bbox)
+            if (y1 - y0 + 1) * (x1 - x0 + 1) < len(candidates):
+                in_cells = set()
+                for cell in self.cells_for_bbox(bbox):
+                    in_cells.update(self.cells.get(cell, ()))
+                if required:
+                    in_cells.intersection_update(candidates)
+                candidates = in_cells
+            candidates = [k for k in candidates if self.intersects(k, bbox)]
+        objects = self.snapshot.objects
+        return {k for k in candidates if self.match(tags_q, objects[k][5])}
+
+    def download(self, downloader, bboxes):
+        """Returns the same dict of OSMPoints as OsmDownloader.download() would."""
+        profile = downloader.profile
+        filters = self.get_filters(profile)
+        if None in bboxes:
+            bboxes = [None]
+        keys = set()
+        for bbox in bboxes:
+            for tags_q in filters:
+                keys.update(self.find(tags_q, bbox))
+        if not profile.get('no_dataset_id', False):
+            ref_key = 'ref:' + profile.get(
+                'dataset_id', required='A fairly unique id of the dataset to query OSM')
+            if not profile.get('bounded_update', False):
+                keys.update(self.keys.get(ref_key, ()))
+            else:
+                for bbox in bboxes:
+                    keys.update(self.find([(ref_key,)], bbox))
+
+        osmdata = {}
+        for key in keys:
+            pt = downloader.make_point(self.snapshot.objects[key])
+            if pt is not None:
+                osmdata[pt.id] = pt
+        logging.debug('Found %s objects in the local snapshot', len(keys))
+        return osmdata
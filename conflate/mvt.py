@@ -0,0 +1,171 @@
+import json
+import logging
+import math
+import os
+import struct
+from collections import defaultdict
+
+
+EXTENT = 4096
+LAYER = 'changes'
+THIN_CELL = 64  # in tile pixels, a cell keeps one feature on lower zooms
+# Features with actions earlier in the list are kept when thinning
+PRIORITY = ('delete', 'create', 'move', 'retag', 'update')
+
+
+def varint(value):
+    """Encodes a non-negative integer as a protobuf varint."""
+    result = bytearray()
+    while value > 0x7F:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, wire_type, data):
+    """Encodes a protobuf field. Data is an integer for varints, and bytes otherwise."""
+    key = varint((number << 3) | wire_type)
+    if wire_type == 0:
+        return key + varint(data)
+    if wire_type == 2:
+        return key + varint(len(data)) + data
+    return key + data
+
+
+def encode_value(value):
+    """Encodes a property value as a Value message of the vector tile spec."""
+    if isinstance(value, bool):
+        return field(7, 0, int(value))
+    if isinstance(value, int):
+        return field(6, 0, zigzag(value))
+    if isinstance(value, float):
+        return field(3, 1, struct.pack('<d', value))
+    if not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False)
+    return field(1, 2, value.encode('utf-8'))
+
+
+def encode_tile(features, name=LAYER):
+    """Encodes a tile with a single layer of point features. Features are tuples
+    of (id, x, y, properties) with coordinates in 0..EXTENT range."""
+    keys = {}
+    values = {}
+    layer = [field(15, 0, 2), field(1, 2, name.encode('utf-8'))]
+    for fid, x, y, props in features:
+        tags = []
+        for k, v in sorted(props.items()):
+            if v is None:
+                continue
+            if k not in keys:
+                keys[k] = len(keys)
+            encoded = encode_value(v)
+            if encoded not in values:
+                values[encoded] = len(values)
+            tags.extend((keys[k], values[encoded]))
+        # A single MoveTo command: id 1, count 1
+        geometry = [9, zigzag(x), zigzag(y)]
+        layer.append(field(2, 2, b''.join((
+            field(1, 0, fid),
+            field(2, 2, b''.join(varint(t) for t in tags)),
+            field(3, 0, 1),  # POINT
+            field(4, 2, b''.join(varint(g) for g in geometry)),
+        ))))
+    layer.extend(field(3, 2, k.encode('utf-8')) for k in keys)
+    layer.extend(field(4, 2, v) for v in values)
+    layer.append(field(5, 0, EXTENT))
+    return field(3, 2, b''.join(layer))
+
+
+class TileBuilder:
+    """Collects GeoJSON point features and writes them as Mapbox vector tiles
+    into "path"/{z}/{x}/{y}.pbf for zoom levels from min_zoom to max_zoom,
+    with a TileJSON manifest. On zoom levels below max_zoom, features are thinned
+    to one for each THIN_CELL pixels, preferring deletions and creations.
+    """
+    def __init__(self, path, min_zoom=0, max_zoom=14):
+        self.path = path
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        # Tuples of (priority, id, world x, world y, properties)
+        self.features = []
+
+    def add(self, feature):
+        lon, lat = feature['geometry']['coordinates']
+        props = feature['properties']
+        lat = max(-85.0511, min(85.0511, lat))
+        wx = (lon + 180.0) / 360.0
+        wy = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0
+        action = props.get('action')
+        if action == 'modify':
+            if 'were_coords' in props:
+                action = 'move'
+            else:
+                action = 'update' if 'ref_id' in props else 'retag'
+        priority = PRIORITY.index(action) if action in PRIORITY else len(PRIORITY)
+        self.features.append((priority, len(self.features) + 1,
+                              min(wx, 1 - 1e-12), min(max(wy, 0), 1 - 1e-12), props))
+
+    def save(self):
+        """Writes tiles and the manifest. Returns the number of tiles."""
+        self.features.sort(key=lambda f: f[:2])
+        counts = {}
+        total = 0
+        fields = {}
+        for f in self.features:
+            for k, v in f[4].items():
+                fields[k] = 'Number' if isinstance(v, (int, float)) and not isinstance(
+                    v, bool) else 'Boolean' if isinstance(v, bool) else 'String'
+        for zoom in range(self.min_zoom, self.max_zoom + 1):
+            scale = (1 << zoom) * EXTENT
+            tiles = defaultdict(list)
+            taken = set()
+            kept = 0
+            for priority, fid, wx, wy, props in self.features:
+                gx = int(wx * scale)
+                gy = int(wy * scale)
+                if zoom < self.max_zoom:
+                    cell = (gx // THIN_CELL, gy // THIN_CELL)
+                    if cell in taken:
+                        continue
+                    taken.add(cell)
+                tiles[(gx // EXTENT, gy // EXTENT)].append(
+                    (fid, gx % EXTENT, gy % EXTENT, props))
+                kept += 1
+            for (x, y), features in tiles.items():
+                dirname = os.path.join(self.path, str(zoom), str(x))
+                os.makedirs(dirname, exist_ok=True)
+                with open(os.path.join(dirname, '{}.pbf'.format(y)), 'wb') as f:
+                    f.write(encode_tile(features))
+            counts[str(zoom)] = {'tiles': len(tiles), 'features': kept}
+            total += len(tiles)
+
+        bounds = [-180, -85.0511, 180, 85.0511]
+        if self.features:
+            wxs = [f[2] for f in self.features]
+            wys = [f[3] for f in self.features]
+            bounds = [min(wxs) * 360 - 180, world_lat(max(wys)),
+                      max(wxs) * 360 - 180, world_lat(min(wys))]
+        manifest = {
+            'tilejson': '3.0.0',
+            'tiles': ['{z}/{x}/{y}.pbf'],
+            'minzoom': self.min_zoom,
+            'maxzoom': self.max_zoom,
+            'bounds': bounds,
+            'vector_layers': [{'id': LAYER, 'fields': fields,
+                               'minzoom': self.min_zoom, 'maxzoom': self.max_zoom}],
+            'counts': counts,
+        }
+        with open(os.path.join(self.path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        logging.info('Wrote %s features into %s tiles', len(self.features), total)
+        return total
+
+
+def world_lat(wy):
+    """Converts a Web Mercator coordinate in 0..1 range to latitude."""
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * wy))))
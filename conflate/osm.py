@@ -1,29 +1,61 @@
 import logging
 import requests
 import re
+import heapq
+import math
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from .data import OSMPoint
+from .overpass import OverpassPool, ALT_OVERPASS_SERVER
 from . import etree
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
-OVERPASS_SERVER = 'https://overpass-api.de/api/'
-ALT_OVERPASS_SERVER = 'https://overpass.kumi.systems/api/'
 OSM_API_SERVER = 'https://api.openstreetmap.org/api/0.6/'
 BBOX_PADDING = 0.003  # in degrees, ~330 m default
+CHUNK_SIZE = 256 * 1024
+MAX_GET_LENGTH = 2000  # longer queries are sent with POST
+METERS_IN_DEGREE = 111320
+API_THREADS = 4  # for checking moveability with OSM API
+MEMBERS_BATCH = 500  # objects in one query for deferred members
 
 
 class OsmDownloader:
     def __init__(self, profile):
         self.profile = profile
-
-    def set_overpass(self, server='alt'):
-        global OVERPASS_SERVER
+        self.cache = None
+        self.tile_cache = None
+        self.defer_members = self.profile.get('defer_members', False)
+        self.backend = None
+        self.osm_api = OSM_API_SERVER
+        self.snapshot = None
+        # For checking moveability of nodes without OSM API
+        self.parent_ways = False
+        self.way_nodes = set()
+        self.checked_nodes = set()
+        self.snapshot_way_nodes = None
+        # Tags of ways and relations with deferred members, see "fetch_members"
+        self.deferred_tags = {}
+        self.threads = 1
+        self.pool = OverpassPool(
+            self.profile.get('overpass_servers'), self.profile.get('overpass_hedge_after'),
+            self.profile.get('overpass_concurrency'))
+
+    def set_overpass(self, server='alt', hedge_after=None):
+        """Sets Overpass API servers to use: "alt" for the alternative one,
+        an URL or a list of URLs. See OverpassPool for hedging."""
         if server == 'alt':
-            OVERPASS_SERVER = ALT_OVERPASS_SERVER
-        else:
-            OVERPASS_SERVER = server
+            server = ALT_OVERPASS_SERVER
+        if isinstance(server, str):
+            server = [server]
+        self.pool = OverpassPool(server, hedge_after, self.profile.get('overpass_concurrency'))
 
-    def construct_overpass_query(self, bboxes):
-        """Constructs an Overpass API query from the "query" list in the profile.
+    def get_tag_strings(self):
+        """Converts the "query" list in the profile into a list of Overpass API filters.
         (k, v) turns into [k=v], (k,) into [k], (k, None) into [!k], (k, "~v") into [k~v]."""
         tags = self.profile.get(
             'query', required="a list of tuples. E.g. [('amenity', 'cafe'), ('name', '~Mc.*lds')]")
@@ -51,8 +83,18 @@ class OsmDownloader:
                         q = '"{}"="{}"'.format(t[0], t[1])
                     tag_str += '[' + q + ']'
                 tag_strs.append(tag_str)
-
-        if self.profile.get('no_dataset_id', False):
+        return tag_strs
+
+    def construct_overpass_query(self, bboxes, with_tags=True, with_ref=True, tag_strs=None):
+        """Constructs an Overpass API query from the "query" list in the profile,
+        or from tag_strs when specified (see "get_tag_strings" method).
+        Bboxes are either lists of four coordinates, or filter strings like 'poly:"..."'.
+        Set with_tags or with_ref to False to skip tag or dataset id clauses."""
+        if tag_strs is None:
+            tag_strs = self.get_tag_strings()
+        if not with_tags:
+            tag_strs = []
+        if self.profile.get('no_dataset_id', False) or not with_ref:
             ref = None
         else:
             ref = 'nwr["ref:' + self.profile.get(
@@ -60,7 +102,7 @@ class OsmDownloader:
         timeout = self.profile.get('overpass_timeout', 120)
         query = '[out:xml]{};('.format('' if timeout is None else '[timeout:{}]'.format(timeout))
         for bbox in bboxes:
-            bbox_str = '' if bbox is None else '(' + ','.join([str(x) for x in bbox]) + ')'
+            bbox_str = area_filter(bbox)
             for tag_str in tag_strs:
                 query += 'nwr' + tag_str + bbox_str + ';'
         if ref is not None:
@@ -68,10 +110,21 @@ class OsmDownloader:
                 query += ref + ';'
             else:
                 for bbox in bboxes:
-                    bbox_str = '' if bbox is None else '(' + ','.join(
-                        [str(x) for x in bbox]) + ')'
-                    query += ref + bbox_str + ';'
-        query += '); out meta qt center;'
+                    query += ref + area_filter(bbox) + ';'
+        if not self.defer_members:
+            query += '); out meta qt center;'
+            found = '_'
+        else:
+            # Only closed ways and multipolygons without members,
+            # which are fetched later for matched objects, see "fetch_members"
+            query += (')->.r; node.r; out meta qt;'
+                      ' way.r(if:is_closed() && count_members() > 2); out tags qt center;'
+                      ' relation.r["type"="multipolygon"](if:count_members() > 0);'
+                      ' out tags qt center;')
+            found = 'r'
+        if self.parent_ways:
+            # Ways containing found nodes, to check which nodes can be moved
+            query += ' node.{}; way(bn); out skel qt;'.format(found)
         return query
 
     def get_bbox(self, points):
@@ -86,102 +139,119 @@ class OsmDownloader:
             bbox[3] = max(bbox[3], p.lon + padding)
         return bbox
 
-    def split_into_bboxes(self, points):
+    def get_footprints(self, bbox, points, max_areas=None):
+        """Replaces a bbox with a list of tighter area filters around dataset points inside it,
+        according to the "query_footprint" profile variable: "around" for a circle
+        around each cluster of points, "poly" for a convex hull, or "bbox" to keep the bbox.
+        Every area filter makes a separate clause for each tag, so circles are used
+        only when there are at most max_areas clusters. Falls back to a hull and then
+        to the bbox when filters are longer than "footprint_max_length" characters."""
+        mode = self.profile.get('query_footprint', 'bbox')
+        if bbox is None or isinstance(bbox, str) or not points or mode == 'bbox':
+            return [bbox]
+        points = points_in_bbox(points, bbox)
+        if not points:
+            return [bbox]
+        padding = self.profile.get('bbox_padding', BBOX_PADDING)
+        max_length = self.profile.get('footprint_max_length', 2000)
+        if mode == 'around':
+            footprints = around_footprints(points, padding)
+            if max_areas is not None and len(footprints) > max_areas:
+                logging.debug('Too many clusters in bbox %s (%s), using a hull',
+                              bbox, len(footprints))
+            elif sum(len(f) for f in footprints) <= max_length:
+                return footprints
+        if mode in ('around', 'poly'):
+            footprint = poly_footprint(points, padding)
+            if len(footprint) <= max_length:
+                return [footprint]
+        else:
+            raise ValueError('Unknown query_footprint value: {}'.format(mode))
+        logging.debug('Footprint for bbox %s is too long, using the bbox', bbox)
+        return [bbox]
+
+    def get_areas(self, bboxes, points, tag_strs, with_ref):
+        """Returns area filters for bboxes, see "get_footprints", keeping
+        the number of clauses within "max_query_clauses"."""
+        max_clauses = self.profile.get('max_query_clauses', 40)
+        max_areas = None
+        if max_clauses:
+            clauses = len(tag_strs)
+            if (with_ref and self.profile.get('bounded_update', False) and
+                    not self.profile.get('no_dataset_id', False)):
+                clauses += 1
+            max_areas = max(1, max_clauses // max(1, clauses) // len(bboxes))
+        return [area for bbox in bboxes
+                for area in self.get_footprints(bbox, points, max_areas)]
+
+    def split_into_bboxes(self, points, max_bboxes=None):
         """
         Splits the dataset into multiple bboxes to lower load on the overpass api.
 
+        Each box keeps its points sorted along both axes. For every box and axis
+        we find the split that frees the most area, and put it into a priority queue,
+        so after splitting a box, only the two resulting boxes are examined again.
+
         Returns a list of tuples (minlat, minlon, maxlat, maxlon).
         """
-        max_bboxes = self.profile.get('max_request_boxes', 4)
+        if max_bboxes is None:
+            max_bboxes = self.profile.get('max_request_boxes', 4)
         if max_bboxes <= 1 or len(points) <= 1:
             return [self.get_bbox(points)]
 
-        # coord, alt coord, total w/h to the left/bottom, total w/h to the right/top
-        lons = sorted([[d.lon, d.lat, 0, 0] for d in points])
-        lats = sorted([[d.lat, d.lon, 0, 0] for d in points])
-
-        def update_side_dimensions(ar):
-            """For each point, calculates the maximum and
-            minimum bound for all points left and right."""
-            fwd_top = fwd_bottom = ar[0][1]
-            back_top = back_bottom = ar[-1][1]
-            for i in range(len(ar)):
-                fwd_top = max(fwd_top, ar[i][1])
-                fwd_bottom = min(fwd_bottom, ar[i][1])
-                ar[i][2] = fwd_top - fwd_bottom
-                back_top = max(back_top, ar[-i-1][1])
-                back_bottom = min(back_bottom, ar[-i-1][1])
-                ar[-i-1][3] = back_top - back_bottom
-
-        def find_max_gap(ar, h):
-            """Select an interval between points, which would give
-            the maximum area if split there."""
-            max_id = None
-            max_gap = 0
-            for i in range(len(ar) - 1):
-                # "Extra" variables are for area to the left and right
-                # that would be freed after splitting.
-                extra_left = (ar[i][0]-ar[0][0]) * (h-ar[i][2])
-                extra_right = (ar[-1][0]-ar[i+1][0]) * (h-ar[i+1][3])
-                # Gap is the area of the column between points i and i+1
-                # plus extra areas to the left and right.
-                gap = (ar[i+1][0] - ar[i][0]) * h + extra_left + extra_right
-                if gap > max_gap:
-                    max_id = i
-                    max_gap = gap
-            return max_id, max_gap
+        # A box is a pair of axes (lats, lons), and an axis is a pair of lists:
+        # coordinates and alternative coordinates, sorted by (coord, alt coord).
+        box = []
+        for axis in (sorted((d.lat, d.lon) for d in points),
+                     sorted((d.lon, d.lat) for d in points)):
+            coords, alts = [a[0] for a in axis], [a[1] for a in axis]
+            if numpy is not None:
+                coords, alts = numpy.array(coords), numpy.array(alts)
+            box.append((coords, alts))
+        boxes = [box]
+        versions = [0]
+        queue = []
+
+        def extent(axis):
+            return axis[0][-1] - axis[0][0]
+
+        def enqueue(box_id):
+            """Pushes best splits for both axes of a box into the queue."""
+            box = boxes[box_id]
+            for ax in range(2):
+                # Size of the box across the axis
+                h = extent(box[1-ax])
+                max_id, max_gap = find_max_gap(box[ax][0], box[ax][1], h)
+                if max_id is not None:
+                    heapq.heappush(queue, (-max_gap, box_id, ax, versions[box_id], max_id))
 
         def get_bbox(b, pad=0):
             """Returns a list of [min_lat, min_lon, max_lat, max_lon] for a box."""
-            return [b[2][0][0]-pad, b[3][0][0]-pad, b[2][-1][0]+pad, b[3][-1][0]+pad]
-
-        def split(box, point_array, point_id):
-            """Split the box over axis point_array at point point_id...point_id+1.
-            Modifies the box in-place and returns a new box."""
-            alt_array = 5 - point_array  # 3->2, 2->3
-            points = box[point_array][point_id+1:]
-            del box[point_array][point_id+1:]
-            alt = {True: [], False: []}  # True means point is in new box
-            for p in box[alt_array]:
-                alt[(p[1], p[0]) >= (points[0][0], points[0][1])].append(p)
-
-            new_box = [None] * 4
-            new_box[point_array] = points
-            new_box[alt_array] = alt[True]
-            box[alt_array] = alt[False]
-            for i in range(2):
-                box[i] = box[i+2][-1][0] - box[i+2][0][0]
-                new_box[i] = new_box[i+2][-1][0] - new_box[i+2][0][0]
-            return new_box
-
-        # height, width, lats, lons
-        boxes = [[lats[-1][0]-lats[0][0], lons[-1][0]-lons[0][0], lats, lons]]
-        initial_area = boxes[0][0] * boxes[0][1]
-        while len(boxes) < max_bboxes and len(boxes) <= len(points):
-            candidate_box = None
-            area = 0
-            point_id = None
-            point_array = None
-            for box in boxes:
-                for ar in (2, 3):
-                    # Find a box and an axis for splitting that would decrease the area the most
-                    update_side_dimensions(box[ar])
-                    max_id, max_area = find_max_gap(box[ar], box[3-ar])
-                    if max_area > area:
-                        area = max_area
-                        candidate_box = box
-                        point_id = max_id
-                        point_array = ar
+            return [float(b[0][0][0])-pad, float(b[1][0][0])-pad,
+                    float(b[0][0][-1])+pad, float(b[1][0][-1])+pad]
+
+        initial_area = extent(box[0]) * extent(box[1])
+        enqueue(0)
+        while len(boxes) < max_bboxes and len(boxes) <= len(points) and queue:
+            area, box_id, ax, version, point_id = heapq.heappop(queue)
+            if version != versions[box_id]:
+                # The box has been split after this entry was queued
+                continue
+            area = -area
             if area * 100 < initial_area:
                 # Stop splitting when the area decrease is less than 1%
                 break
+            box = boxes[box_id]
             logging.debug('Splitting bbox %s at %s %s..%s; area decrease %s%%',
-                          get_bbox(candidate_box),
-                          'longs' if point_array == 3 else 'lats',
-                          candidate_box[point_array][point_id][0],
-                          candidate_box[point_array][point_id+1][0],
+                          get_bbox(box), 'longs' if ax == 1 else 'lats',
+                          box[ax][0][point_id], box[ax][0][point_id+1],
                           round(100*area/initial_area))
-            boxes.append(split(candidate_box, point_array, point_id))
+            boxes[box_id], new_box = split_box(box, ax, point_id)
+            boxes.append(new_box)
+            versions[box_id] += 1
+            versions.append(0)
+            enqueue(box_id)
+            enqueue(len(boxes) - 1)
 
         padding = self.profile.get('bbox_padding', BBOX_PADDING)
         return [get_bbox(b, padding) for b in boxes]
@@ -256,9 +326,36 @@ class OsmDownloader:
             bboxes = self.split_into_bboxes(dataset_points)
         return bboxes
 
-    def download(self, bboxes=None):
-        """Constructs an Overpass API query and requests objects
-        to match from a server."""
+    def get_batches(self, tag_strs, bboxes, with_ref=True):
+        """Splits the cross product of tag clauses and bboxes into batches
+        of at most "max_query_clauses" clauses each.
+        Returns a list of tuples (tag_strs, bboxes, with_ref)."""
+        max_clauses = self.profile.get('max_query_clauses', 40)
+        has_ref = with_ref and not self.profile.get('no_dataset_id', False)
+        bounded = self.profile.get('bounded_update', False)
+        ref_clauses = 0 if not has_ref else len(bboxes) if bounded else 1
+        if not max_clauses or len(tag_strs) * len(bboxes) + ref_clauses <= max_clauses:
+            return [(tag_strs, bboxes, True)]
+        if has_ref and bounded:
+            # A bounded dataset id clause is the same as a tag clause
+            tag_strs = tag_strs + ['["ref:{}"]'.format(self.profile.get('dataset_id'))]
+        tags_per_batch = min(len(tag_strs), max_clauses)
+        bboxes_per_batch = max(1, max_clauses // tags_per_batch)
+        batches = []
+        for i in range(0, len(tag_strs), tags_per_batch):
+            for j in range(0, len(bboxes), bboxes_per_batch):
+                batches.append((tag_strs[i:i+tags_per_batch],
+                                bboxes[j:j+bboxes_per_batch], False))
+        if has_ref and not bounded:
+            batches[0] = (batches[0][0], batches[0][1], True)
+        return batches
+
+    def download(self, bboxes=None, points=None):
+        """Constructs Overpass API queries and requests objects
+        to match from a server, or from a local backend when set.
+        Queries with too many clauses are split into batches, which are
+        requested in "threads" parallel threads. When dataset points are given,
+        bboxes that time out or run out of memory are split and requested again."""
         if not bboxes:
             pbbox = self.profile.get('bbox', True)
             if pbbox and hasattr(pbbox, '__len__') and len(pbbox) == 4:
@@ -266,126 +363,660 @@ class OsmDownloader:
             else:
                 bboxes = [None]
 
-        query = self.construct_overpass_query(bboxes)
-        logging.debug('Overpass query: %s', query)
-        r = requests.get(OVERPASS_SERVER + 'interpreter', {'data': query})
-        if r.encoding is None:
-            r.encoding = 'utf-8'
-        if r.status_code != 200:
-            logging.error('Failed to download data from Overpass API: %s', r.status_code)
-            if 'rate_limited' in r.text:
-                r = requests.get(OVERPASS_SERVER + 'status')
-                logging.warning('Seems like you are rate limited. API status:\n%s', r.text)
-            else:
-                logging.error('Error message: %s', r.text)
-            raise IOError()
-        if 'runtime error: ' in r.text:
-            m = re.search(r'runtime error: ([^<]+)', r.text)
-            error = 'unknown' if not m else m.group(1)
-            if 'Query timed out' in error:
-                logging.error(
-                    'Query timed out, try increasing the "overpass_timeout" profile variable')
+        if self.backend is not None:
+            return self.backend.download(self, bboxes)
+
+        if self.cache is None or not self.cache.single_file:
+            return self.download_batches(bboxes, points)
+        # A single file is used for all queries, so it is written once from all responses
+        cached = self.cache.open(None)
+        if cached is not None:
+            logging.info('Using cached Overpass API response')
+            with cached:
+                return self.parse_xml(cached)
+        try:
+            osmdata = self.download_batches(bboxes, points)
+        except BaseException:
+            self.cache.discard_parts()
+            raise
+        self.cache.write_parts()
+        return osmdata
+
+    def download_batches(self, bboxes, points=None):
+        """Requests objects in bboxes, from tiles or in batches of clauses."""
+        if self.tile_cache is not None:
+            if None not in bboxes:
+                return self.download_tiles(bboxes)
+            logging.warning('Cannot use tiles without a bbox')
+
+        batches = self.get_batches(self.get_tag_strings(), bboxes)
+        if len(batches) == 1:
+            return self.download_batch(*batches[0], points=points)
+        logging.info('Splitting the query into %s batches', len(batches))
+        osmdata = {}
+        with ThreadPoolExecutor(self.threads) as executor:
+            futures = [executor.submit(self.download_batch, *batch, points=points)
+                       for batch in batches]
+            for future in futures:
+                # Objects are deduplicated by their ids
+                osmdata.update(future.result())
+        return osmdata
+
+    def download_batch(self, tag_strs, bboxes, with_ref, points=None):
+        """Requests objects for a batch of clauses, splitting it into bboxes
+        when the query is too large."""
+        query = self.construct_overpass_query(
+            self.get_areas(bboxes, points, tag_strs, with_ref),
+            with_ref=with_ref, tag_strs=tag_strs)
+        try:
+            return self.query_overpass(query)
+        except QueryTooLarge as e:
+            if not points or None in bboxes:
+                log_query_too_large(e)
+                raise
+            # A single bbox has failed already, so it is split right away
+            error = e if len(bboxes) == 1 else None
+            if error is None:
+                logging.warning('Query failed (%s), requesting each of %s bboxes separately',
+                                e, len(bboxes))
+
+        osmdata = {}
+        bounded = self.profile.get('bounded_update', False)
+        if with_ref and not bounded and not self.profile.get('no_dataset_id', False):
+            # Request the unbounded dataset id clause only once
+            query = self.construct_overpass_query([None], with_tags=False)
+            osmdata.update(self.query_overpass(query))
+        for bbox in bboxes:
+            osmdata.update(self.download_split(
+                bbox, points_in_bbox(points, bbox), tag_strs, with_ref and bounded,
+                error=error))
+        return osmdata
+
+    def download_split(self, bbox, points, tag_strs=None, with_ref=True, depth=0, error=None):
+        """Requests objects in a bbox, recursively splitting it by dataset points
+        inside when the query is too large, up to "max_split_depth" times.
+        When the bbox has already failed with an error, it is split without a request."""
+        if error is None:
+            query = self.construct_overpass_query(
+                self.get_areas([bbox], points, tag_strs or self.get_tag_strings(), with_ref),
+                with_ref=with_ref, tag_strs=tag_strs)
+            try:
+                return self.query_overpass(query)
+            except QueryTooLarge as e:
+                error = e
+        max_depth = self.profile.get('max_split_depth', 4)
+        sub_bboxes = [] if depth >= max_depth else self.split_into_bboxes(points, 4)
+        if len(sub_bboxes) < 2:
+            log_query_too_large(error)
+            raise error
+        logging.warning('Query failed (%s), splitting bbox %s into %s',
+                        error, bbox, len(sub_bboxes))
+        osmdata = {}
+        for sub_bbox in sub_bboxes:
+            osmdata.update(self.download_split(
+                sub_bbox, points_in_bbox(points, sub_bbox), tag_strs, with_ref, depth + 1))
+        return osmdata
+
+    def download_tiles(self, bboxes):
+        """Assembles objects in bboxes from the tile cache, requesting only
+        tiles that are missing or expired. The unbounded dataset id clause
+        is requested separately."""
+        tag_strs = self.get_tag_strings()
+        has_ref = not self.profile.get('no_dataset_id', False)
+        bounded = self.profile.get('bounded_update', False)
+        if has_ref and bounded:
+            tag_strs = tag_strs + ['["ref:{}"]'.format(self.profile.get('dataset_id'))]
+        signature = self.tile_cache.key(*sorted(tag_strs))
+        if self.defer_members:
+            signature = self.tile_cache.key(signature, 'defer_members')
+        tiles = set()
+        for bbox in bboxes:
+            tiles.update(self.tile_cache.tiles_for_bbox(bbox))
+        records = {}
+        missing = []
+        for tile in sorted(tiles):
+            tile_records = self.tile_cache.load(signature, tile)
+            if tile_records is None:
+                missing.append(tile)
             else:
-                logging.error('Runtime error: %s', error)
-            raise IOError()
-        return self.parse_xml(r.content)
+                records.update(((r[0], r[1]), r) for r in tile_records)
+        for record in records.values():
+            if record[0] == 'way' and record[6]:
+                self.way_nodes.update(int(ref) for ref in record[6])
+        logging.info('Found %s of %s tiles in the cache', len(tiles) - len(missing), len(tiles))
+        if missing:
+            for tile, tile_records in self.fetch_tiles(missing, tag_strs).items():
+                self.tile_cache.save(signature, tile, tile_records)
+                records.update(((r[0], r[1]), r) for r in tile_records)
+            self.tile_cache.evict()
+
+        osmdata = {}
+        for record in records.values():
+            # Tiles cover more than bboxes, so we filter objects by their centers
+            if any(bbox[0] <= record[3] <= bbox[2] and bbox[1] <= record[4] <= bbox[3]
+                   for bbox in bboxes):
+                pt = self.make_point(record)
+                if pt is not None:
+                    osmdata[pt.id] = pt
+        if has_ref and not bounded:
+            query = self.construct_overpass_query([None], with_tags=False)
+            osmdata.update(self.query_overpass(query))
+        return osmdata
 
-    def parse_xml(self, fileobj):
+    def fetch_tiles(self, tiles, tag_strs):
+        """Requests objects for tiles, merging adjacent tiles in rows into single bboxes.
+        Returns a dict of tile -> list of records, with each object assigned
+        to the tile with its center."""
+        runs = []
+        for tile in sorted(tiles, key=lambda t: (t[1], t[0])):
+            if runs and runs[-1][-1] == (tile[0] - 1, tile[1]):
+                runs[-1].append(tile)
+            else:
+                runs.append([tile])
+        batches = self.get_batches(tag_strs, runs, with_ref=False)
+        logging.info('Downloading %s tiles in %s queries', len(tiles), len(batches))
+        with ThreadPoolExecutor(self.threads) as executor:
+            results = list(executor.map(lambda b: self.fetch_tile_runs(b[1], b[0]), batches))
+
+        by_tile = {tile: {} for tile in tiles}
+        for records in results:
+            for r in records:
+                tile = self.tile_cache.get_tile(r[3], r[4])
+                if tile not in by_tile:
+                    tile = min(tiles, key=lambda t: (t[0] - tile[0]) ** 2 + (t[1] - tile[1]) ** 2)
+                by_tile[tile][(r[0], r[1])] = r
+        return {tile: list(records.values()) for tile, records in by_tile.items()}
+
+    def fetch_tile_runs(self, runs, tag_strs):
+        """Requests raw records for rows of tiles, splitting them into single tiles
+        when the query is too large."""
+        bboxes = []
+        for run in runs:
+            first = self.tile_cache.tile_bbox(run[0])
+            last = self.tile_cache.tile_bbox(run[-1])
+            bboxes.append([first[0], first[1], first[2], last[3]])
+        query = self.construct_overpass_query(bboxes, with_ref=False, tag_strs=tag_strs)
+        try:
+            return self.query_overpass(query, raw=True)
+        except QueryTooLarge as e:
+            if len(runs) == 1 and len(runs[0]) == 1:
+                log_query_too_large(e)
+                raise
+            logging.warning('Query failed (%s), requesting each tile separately', e)
+        records = []
+        for run in runs:
+            for tile in run:
+                records.extend(self.fetch_tile_runs([[tile]], tag_strs))
+        return records
+
+    def query_overpass(self, query, raw=False, use_cache=True):
+        """Sends the query to the Overpass API, or takes a response from the cache,
+        and parses it. See "parse_xml_stream" for the raw argument."""
+        logging.debug('Overpass query: %s', query)
+        cache_key = None
+        if self.cache and use_cache and not self.cache.single_file:
+            cache_key = self.cache.key(self.pool.key, query)
+            cached = self.cache.open(cache_key)
+            if cached is not None:
+                logging.info('Using cached Overpass API response')
+                with cached:
+                    return self.parse_xml(cached, raw, self.parent_ways)
+        method = 'post' if len(query) > MAX_GET_LENGTH else 'get'
+        with self.pool.request(query, method) as r:
+            if r.encoding is None:
+                r.encoding = 'utf-8'
+            if r.status_code != 200:
+                logging.error('Failed to download data from Overpass API: %s', r.status_code)
+                logging.error('Error message: %s', r.text)
+                raise IOError()
+            chunks = r.iter_content(CHUNK_SIZE)
+            tee = None
+            part = None
+            if cache_key:
+                tee = chunks = self.cache.tee(cache_key, chunks)
+            elif self.cache and use_cache:
+                # Responses are merged into a single file after the download
+                part = self.cache.new_part()
+                tee = chunks = self.cache.tee_part(part, chunks)
+            try:
+                return self.parse_xml_stream(chunks, raw, self.parent_ways)
+            except BaseException:
+                if part is not None:
+                    # A runtime error or a cut off response can come after the last chunk
+                    self.cache.discard_part(part)
+                raise
+            finally:
+                if tee is not None:
+                    # Discards the incomplete cache entry on errors
+                    tee.close()
+
+    def parse_xml(self, fileobj, raw=False, parent_ways=False):
         """Parses an OSM XML file into the "osmdata" field. For ways and relations,
         finds the center. Drops objects that do not match the overpass query tags
         (see "check_against_profile_tags" method)."""
         if isinstance(fileobj, bytes):
-            xml = etree.fromstring(fileobj)
-        else:
-            xml = etree.parse(fileobj).getroot()
+            return self.parse_xml_stream([fileobj], raw, parent_ways)
+        return self.parse_xml_stream(
+            iter(lambda: fileobj.read(CHUNK_SIZE), fileobj.read(0)), raw, parent_ways)
+
+    def parse_xml_stream(self, chunks, raw=False, parent_ways=False):
+        """Parses OSM XML fed as an iterable of chunks, processing
+        each element as soon as it has been read, and then discarding it.
+        Raises IOError when the Overpass API reports a runtime error.
+        If raw is True, returns a list of records (see "parse_element" method)
+        without filtering them by the profile. Set parent_ways to True
+        when the response includes all ways for its nodes, to remember
+        that nodes not in these ways can be moved."""
+        parser = etree.XMLPullParser(events=('start', 'end'))
         nodes = {}
-        for nd in xml.findall('node'):
-            nodes[nd.get('id')] = (float(nd.get('lat')), float(nd.get('lon')))
         ways = {}
-        for way in xml.findall('way'):
-            center = way.find('center')
+        osmdata = [] if raw else {}
+        root = None
+        depth = 0
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            parser.feed(chunk)
+            for event, el in parser.read_events():
+                if event == 'start':
+                    if root is None:
+                        root = el
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                if el.tag == 'way':
+                    # Nodes in ways cannot be moved, see "check_moveability"
+                    self.way_nodes.update(int(nd.get('ref')) for nd in el.findall('nd'))
+                if el.tag == 'remark':
+                    check_runtime_error(el.text or '')
+                elif (el.tag == 'way' and el.get('version') is None and
+                      el.find('center') is None):
+                    # Parent ways from "out skel" are only needed for their nodes
+                    pass
+                else:
+                    if parent_ways and el.tag == 'node':
+                        self.checked_nodes.add(int(el.get('id')))
+                    record = self.parse_element(el, nodes, ways)
+                    if record is None:
+                        pass
+                    elif raw:
+                        osmdata.append(record)
+                    else:
+                        pt = self.make_point(record)
+                        if pt is not None:
+                            osmdata[pt.id] = pt
+                root.remove(el)
+        parser.close()
+        return osmdata
+
+    @staticmethod
+    def parse_element(el, nodes, ways):
+        """Makes a record of (type, id, version, lat, lon, tags, members) out of
+        an XML element. Coordinates for nodes and centers for ways are recorded
+        in the "nodes" and "ways" dicts, to be used for finding centers
+        of subsequent ways and relations. Returns None for objects without
+        coordinates and for non-OSM elements."""
+        if el.tag == 'node':
+            coord = (float(el.get('lat')), float(el.get('lon')))
+            nodes[el.get('id')] = coord
+            members = None
+        elif el.tag == 'way':
+            center = el.find('center')
             if center is not None:
-                ways[way.get('id')] = [float(center.get('lat')), float(center.get('lon'))]
+                coord = [float(center.get('lat')), float(center.get('lon'))]
             else:
-                logging.debug('Way %s does not have a center', way.get('id'))
+                logging.debug('Way %s does not have a center', el.get('id'))
                 coord = [0, 0]
                 count = 0
-                for nd in way.findall('nd'):
+                for nd in el.findall('nd'):
                     if nd.get('ref') in nodes:
                         count += 1
                         for i in range(len(coord)):
                             coord[i] += nodes[nd.get('ref')][i]
-                ways[way.get('id')] = [coord[0] / count, coord[1] / count]
-
+                if count > 0:
+                    coord = [coord[0] / count, coord[1] / count]
+            ways[el.get('id')] = coord
+            members = [nd.get('ref') for nd in el.findall('nd')]
+        elif el.tag == 'relation':
+            center = el.find('center')
+            if center is not None:
+                coord = [float(center.get('lat')), float(center.get('lon'))]
+            else:
+                logging.debug('Relation %s does not have a center', el.get('id'))
+                coord = [0, 0]
+                count = 0
+                for m in el.findall('member'):
+                    if m.get('type') == 'node' and m.get('ref') in nodes:
+                        count += 1
+                        for i in range(len(coord)):
+                            coord[i] += nodes[m.get('ref')][i]
+                    elif m.get('type') == 'way' and m.get('ref') in ways:
+                        count += 1
+                        for i in range(len(coord)):
+                            coord[i] += ways[m.get('ref')][i]
+                if count > 0:
+                    coord = [coord[0] / count, coord[1] / count]
+            members = [
+                (m.get('type'), m.get('ref'), m.get('role'))
+                for m in el.findall('member')
+            ]
+        else:
+            return None
+
+        if not coord or coord == [0, 0]:
+            return None
+        tags = {}
+        for tag in el.findall('tag'):
+            tags[tag.get('k')] = tag.get('v')
+        version = el.get('version')
+        if version is None and el.tag != 'node':
+            # Ways and relations from "out tags" with deferred members
+            members = None
+        return (el.tag, int(el.get('id')), None if version is None else int(version),
+                coord[0], coord[1], tags, members)
+
+    def fetch_members(self, points):
+        """Downloads versions and members of ways and relations, which were
+        skipped with the "defer_members" profile variable, for given OSMPoints.
+        Objects could have been edited since they were downloaded without versions,
+        so their tags are compared with the first response. Returns a set of ids
+        of points with changed tags, which are left without members."""
+        deferred = {(p.osm_type, p.osm_id): p for p in points
+                    if p.osm_type != 'node' and p.members is None}
+        if not deferred:
+            return set()
+        logging.info('Downloading members of %s ways and relations', len(deferred))
+        keys = sorted(deferred)
+        timeout = self.profile.get('overpass_timeout', 120)
+        queries = []
+        for i in range(0, len(keys), MEMBERS_BATCH):
+            ids = defaultdict(list)
+            for osm_type, osm_id in keys[i:i+MEMBERS_BATCH]:
+                ids[osm_type].append(str(osm_id))
+            query = '[out:xml]{};('.format(
+                '' if timeout is None else '[timeout:{}]'.format(timeout))
+            for osm_type, type_ids in sorted(ids.items()):
+                query += '{}(id:{});'.format(osm_type, ','.join(type_ids))
+            queries.append(query + '); out meta qt center;')
+        # A single file cache would return the same file for these queries
+        use_cache = self.cache is not None and not self.cache.single_file
+        with ThreadPoolExecutor(self.threads) as executor:
+            results = list(executor.map(
+                lambda q: self.query_overpass(q, raw=True, use_cache=use_cache), queries))
+        changed = set()
+        for records in results:
+            for record in records:
+                p = deferred.get((record[0], record[1]))
+                if p is None or record[6] is None:
+                    continue
+                if record[5] != self.deferred_tags.get((record[0], record[1])):
+                    changed.add(p.id)
+                    continue
+                p.version = record[2]
+                p.members = record[6]
+                if p.osm_type == 'relation':
+                    p.members = [tuple(m) for m in record[6]]
+        if changed:
+            logging.warning('%s objects were edited in OSM since they were downloaded, '
+                            'skipping them: %s', len(changed), ', '.join(sorted(changed)[:10]))
+        missing = [p.id for p in deferred.values() if p.members is None and p.id not in changed]
+        if missing:
+            raise IOError('Could not download members of {}'.format(', '.join(missing[:10])))
+        return changed
+
+    def get_moveability(self, node_id):
+        """Returns whether a node is not in any way, judging by downloaded data
+        or the snapshot made from a full extract, or None if we do not know."""
+        if self.snapshot is not None and self.snapshot.full_extract:
+            if self.snapshot_way_nodes is None:
+                self.snapshot_way_nodes = set(
+                    int(ref) for key, record in self.snapshot.objects.items()
+                    if key[0] == 'way' and record[6] for ref in record[6])
+            if node_id in self.snapshot.nodes:
+                return node_id not in self.snapshot_way_nodes
+        if node_id in self.way_nodes:
+            return False
+        if node_id in self.checked_nodes:
+            return True
+        return None
+
+    def check_moveability(self, changes, versions=None):
+        """Sets "can_move" attribute for modified nodes in ChangeRecords.
+        Most nodes are checked offline (see "get_moveability"), and others
+        with OSM API. Its answers are cached for node versions from the dict."""
+        to_check = [c for c in changes if c.osm_type == 'node' and c.action == 'modify']
+        logging.info('Checking moveability of %s modified nodes', len(to_check))
+        cache = self.cache if self.cache is not None and not self.cache.single_file else None
+        versions = versions or {}
+        cache_keys = {}
+        unknown = []
+        for c in to_check:
+            c.can_move = self.get_moveability(c.osm_id)
+            if c.can_move is None and cache and c.osm_id in versions:
+                cache_keys[c.osm_id] = cache.key(
+                    'moveability', self.osm_api, c.osm_id, versions[c.osm_id])
+                f = cache.open(cache_keys[c.osm_id])
+                if f is not None:
+                    with f:
+                        c.can_move = f.read() == b'1'
+            if c.can_move is None:
+                unknown.append(c)
+        if not unknown:
+            return
+        logging.info('Asking OSM API about %s nodes', len(unknown))
+        result = fetch_moveability([c.osm_id for c in unknown], self.osm_api)
+        for c in unknown:
+            can_move = result[c.osm_id]
+            c.can_move = bool(can_move)
+            if can_move is not None and c.osm_id in cache_keys:
+                cache.store(cache_keys[c.osm_id], b'1' if can_move else b'0', evict=False)
+        if cache_keys:
+            cache.evict()
+
+    def make_point(self, record, categories=None):
+        """Makes an OSMPoint out of a record from "parse_element".
+        Categories are calculated when not specified.
+        Returns None if the object does not match the profile."""
+        osm_type, osm_id, version, lat, lon, tags, members = record
+        if categories is None:
+            categories = self.get_categories(tags)
+        if categories is False or categories is None or len(categories) == 0:
+            return None
+        pt = OSMPoint(osm_type, osm_id, version, lat, lon, tags, categories)
+        pt.members = members
+        if osm_type == 'relation' and members:
+            pt.members = [tuple(m) for m in members]
+        if not pt.is_poi():
+            return None
+        if members is None and osm_type != 'node':
+            self.deferred_tags[(osm_type, osm_id)] = tags
         # For calculating weight of OSM objects
         weight_fn = self.profile.get_raw('weight')
-        osmdata = {}
-
-        for el in xml:
-            tags = {}
-            for tag in el.findall('tag'):
-                tags[tag.get('k')] = tag.get('v')
-            categories = self.get_categories(tags)
-            if categories is False or categories is None or len(categories) == 0:
-                continue
-
-            if el.tag == 'node':
-                coord = nodes[el.get('id')]
-                members = None
-            elif el.tag == 'way':
-                coord = ways[el.get('id')]
-                members = [nd.get('ref') for nd in el.findall('nd')]
-            elif el.tag == 'relation':
-                center = el.find('center')
-                if center is not None:
-                    coord = [float(center.get('lat')), float(center.get('lon'))]
+        if callable(weight_fn):
+            weight = weight_fn(pt)
+            if weight:
+                if abs(weight) > 3:
+                    pt.dist_offset = weight
                 else:
-                    logging.debug('Relation %s does not have a center', el.get('id'))
-                    coord = [0, 0]
-                    count = 0
-                    for m in el.findall('member'):
-                        if m.get('type') == 'node' and m.get('ref') in nodes:
-                            count += 1
-                            for i in range(len(coord)):
-                                coord[i] += nodes[m.get('ref')][i]
-                        elif m.get('type') == 'way' and m.get('ref') in ways:
-                            count += 1
-                            for i in range(len(coord)):
-                                coord[i] += ways[m.get('ref')][i]
-                    if count > 0:
-                        coord = [coord[0] / count, coord[1] / count]
-                members = [
-                    (m.get('type'), m.get('ref'), m.get('role'))
-                    for m in el.findall('member')
-                ]
-            else:
-                continue
-            if not coord or coord == [0, 0]:
-                continue
-            pt = OSMPoint(
-                el.tag, int(el.get('id')), int(el.get('version')),
-                coord[0], coord[1], tags, categories)
-            pt.members = members
-            if pt.is_poi():
-                if callable(weight_fn):
-                    weight = weight_fn(pt)
-                    if weight:
-                        if abs(weight) > 3:
-                            pt.dist_offset = weight
-                        else:
-                            pt.dist_offset = weight * self.profile.max_distance
-                osmdata[pt.id] = pt
-        return osmdata
-
+                    pt.dist_offset = weight * self.profile.max_distance
+        return pt
+
+
+def find_max_gap(coords, alts, h):
+    """Select an interval between points, which would give
+    the maximum area if split there. Returns its index and the area."""
+    if len(coords) < 2:
+        return None, 0
+    if numpy is not None:
+        # For each point, the extent of alt coords for all points left and right
+        fwd = numpy.maximum.accumulate(alts) - numpy.minimum.accumulate(alts)
+        back = (numpy.maximum.accumulate(alts[::-1]) -
+                numpy.minimum.accumulate(alts[::-1]))[::-1]
+        # "Extra" variables are for area to the left and right
+        # that would be freed after splitting.
+        extra_left = (coords[:-1] - coords[0]) * (h - fwd[:-1])
+        extra_right = (coords[-1] - coords[1:]) * (h - back[1:])
+        gaps = (coords[1:] - coords[:-1]) * h + extra_left + extra_right
+        max_id = int(numpy.argmax(gaps))
+        if gaps[max_id] <= 0:
+            return None, 0
+        return max_id, float(gaps[max_id])
+
+    n = len(coords)
+    fwd = [0] * n
+    back = [0] * n
+    fwd_top = fwd_bottom = alts[0]
+    back_top = back_bottom = alts[-1]
+    for i in range(n):
+        fwd_top = max(fwd_top, alts[i])
+        fwd_bottom = min(fwd_bottom, alts[i])
+        fwd[i] = fwd_top - fwd_bottom
+        back_top = max(back_top, alts[-i-1])
+        back_bottom = min(back_bottom, alts[-i-1])
+        back[-i-1] = back_top - back_bottom
+    max_id = None
+    max_gap = 0
+    for i in range(n - 1):
+        extra_left = (coords[i]-coords[0]) * (h-fwd[i])
+        extra_right = (coords[-1]-coords[i+1]) * (h-back[i+1])
+        # Gap is the area of the column between points i and i+1
+        # plus extra areas to the left and right.
+        gap = (coords[i+1] - coords[i]) * h + extra_left + extra_right
+        if gap > max_gap:
+            max_id = i
+            max_gap = gap
+    return max_id, max_gap
+
+
+def split_box(box, ax, point_id):
+    """Split the box over axis ax at point point_id...point_id+1.
+    Returns two new boxes, the second one with the points after the split."""
+    coords, alts = box[ax]
+    first = (coords[point_id+1], alts[point_id+1])
+    alt_coords, alt_alts = box[1-ax]
+    # Point goes into the new box when (coord, alt coord) >= first
+    if numpy is not None:
+        in_new = (alt_alts > first[0]) | ((alt_alts == first[0]) & (alt_coords >= first[1]))
+        alt_old = (alt_coords[~in_new], alt_alts[~in_new])
+        alt_new = (alt_coords[in_new], alt_alts[in_new])
+    else:
+        alt_old = ([], [])
+        alt_new = ([], [])
+        for c, a in zip(alt_coords, alt_alts):
+            target = alt_new if (a, c) >= first else alt_old
+            target[0].append(c)
+            target[1].append(a)
+    old_axis = (coords[:point_id+1], alts[:point_id+1])
+    new_axis = (coords[point_id+1:], alts[point_id+1:])
+    if ax == 0:
+        return (old_axis, alt_old), (new_axis, alt_new)
+    return (alt_old, old_axis), (alt_new, new_axis)
+
+
+class QueryTooLarge(IOError):
+    """Raised when an Overpass API query times out or runs out of memory."""
+    pass
+
+
+def check_runtime_error(text):
+    """Raises IOError if the text contains an Overpass API runtime error."""
+    if 'runtime error: ' not in text:
+        return
+    m = re.search(r'runtime error: ([^<]+)', text)
+    error = 'unknown' if not m else m.group(1).strip()
+    if 'Query timed out' in error or 'out of memory' in error:
+        raise QueryTooLarge(error)
+    logging.error('Runtime error: %s', error)
+    raise IOError(error)
+
+
+def log_query_too_large(error):
+    if 'Query timed out' in str(error):
+        logging.error(
+            'Query timed out, try increasing the "overpass_timeout" profile variable')
+    else:
+        logging.error('Runtime error: %s', error)
+
+
+def area_filter(bbox):
+    """Formats a bbox or a footprint for an Overpass API query."""
+    if bbox is None:
+        return ''
+    if isinstance(bbox, str):
+        return '(' + bbox + ')'
+    return '(' + ','.join([str(x) for x in bbox]) + ')'
+
+
+def around_footprints(points, padding):
+    """Returns a list of "around" filters, one for each cluster of points
+    on a grid with cells of half the padding."""
+    cell = padding / 2
+    clusters = defaultdict(list)
+    for p in points:
+        clusters[(int(p.lat // cell), int(p.lon // cell))].append(p)
+    footprints = []
+    for _, cluster in sorted(clusters.items()):
+        lat = round(sum(p.lat for p in cluster) / len(cluster), 5)
+        lon = round(sum(p.lon for p in cluster) / len(cluster), 5)
+        # Degrees of longitude are not longer than of latitude, so the circle
+        # covers the padding around the farthest point
+        spread = max(math.hypot(p.lat - lat, p.lon - lon) for p in cluster)
+        radius = int(math.ceil((padding + spread) * METERS_IN_DEGREE))
+        # Several coordinates in one filter would make a buffer around a line
+        # connecting them, so each cluster gets its own filter
+        footprints.append('around:{},{},{}'.format(radius, lat, lon))
+    return footprints
+
+
+def poly_footprint(points, padding):
+    """Returns a "poly" filter for a convex hull of points,
+    each of them padded to a square."""
+    corners = set()
+    for p in points:
+        for dlat in (-padding, padding):
+            for dlon in (-padding, padding):
+                corners.add((round(p.lat + dlat, 5), round(p.lon + dlon, 5)))
+    corners = sorted(corners)
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    # Andrew's monotone chain
+    hull = []
+    for part in (corners, reversed(corners)):
+        chain = []
+        for c in part:
+            while len(chain) >= 2 and cross(chain[-2], chain[-1], c) <= 0:
+                chain.pop()
+            chain.append(c)
+        hull.extend(chain[:-1])
+    return 'poly:"{}"'.format(' '.join('{} {}'.format(c[0], c[1]) for c in hull))
+
+
+def points_in_bbox(points, bbox):
+    return [p for p in points
+            if bbox[0] <= p.lat <= bbox[2] and bbox[1] <= p.lon <= bbox[3]]
+
+
+def fetch_moveability(node_ids, api=OSM_API_SERVER, threads=API_THREADS):
+    """Asks OSM API in parallel which nodes are not in any ways.
+    Returns a dict of node id -> True, False or None if the request failed."""
+    local = threading.local()
+
+    def fetch(node_id):
+        if not hasattr(local, 'session'):
+            # Reusing connections for each thread
+            local.session = requests.Session()
+        try:
+            r = local.session.get('{}node/{}/ways'.format(api, node_id), timeout=60)
+        except requests.RequestException as e:
+            logging.debug('Could not get ways of node %s: %s', node_id, e)
+            return node_id, None
+        if r.status_code != 200:
+            return node_id, None
+        return node_id, etree.fromstring(r.content).find('way') is None
 
-def check_moveability(changes):
-    to_check = [x for x in changes if x['properties']['osm_type'] == 'node' and
-                x['properties']['action'] == 'modify']
-    logging.info('Checking moveability of %s modified nodes', len(to_check))
-    for c in to_check:
-        p = c['properties']
-        p['can_move'] = False
-        r = requests.get('{}node/{}/ways'.format(OSM_API_SERVER, p['osm_id']))
-        if r.status_code == 200:
-            xml = etree.fromstring(r.content)
-            p['can_move'] = xml.find('way') is None
+    with ThreadPoolExecutor(threads) as executor:
+        return dict(executor.map(fetch, node_ids))
@@ -0,0 +1,309 @@
+import logging
+import queue
+import random
+import re
+import threading
+import time
+import requests
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+
+OVERPASS_SERVER = 'https://overpass-api.de/api/'
+ALT_OVERPASS_SERVER = 'https://overpass.kumi.systems/api/'
+MAX_CONCURRENT = 2
+MAX_RETRIES = 5
+RETRY_DELAY = 15  # in seconds, doubled on each retry
+DEFAULT_LATENCY = 1.0  # in seconds, for servers we have not heard from
+EWMA_ALPHA = 0.3
+
+
+def parse_status(text):
+    """Parses a response from the /status endpoint of an Overpass API server.
+    Returns a tuple of (rate limit, available slots, seconds until the next slot).
+    Any value can be None if missing."""
+    m = re.search(r'^Rate limit: (\d+)', text, re.M)
+    rate_limit = None if not m else int(m.group(1))
+    m = re.search(r'^(\d+) slots? available now', text, re.M)
+    available = 0 if not m else int(m.group(1))
+    waits = [int(x) for x in re.findall(
+        r'^Slot available after: .*, in (-?\d+) seconds', text, re.M)]
+    if m is None and not waits and rate_limit is None:
+        available = None
+    return rate_limit, available, None if not waits else max(0, min(waits))
+
+
+def parse_retry_after(value):
+    """Returns the number of seconds from a Retry-After header, or None."""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class OverpassScheduler:
+    """Paces requests to an Overpass API server.
+
+    Keeps the number of simultaneous requests under the server rate limit
+    (taken from its /status page) and the "max_concurrent" cap, and
+    when the server reports it is rate limited, postpones requests until
+    a slot becomes free. Requests wait in a queue for their turn.
+    """
+    def __init__(self, server, max_concurrent=MAX_CONCURRENT, max_retries=MAX_RETRIES):
+        self.server = server
+        self.max_concurrent = max_concurrent
+        self.rate_limit = None
+        self.limit = max_concurrent
+        self.max_retries = max_retries
+        self.running = 0
+        self.not_before = 0
+        self.status_checked = False
+        self.status_lock = threading.Lock()
+        self.cond = threading.Condition()
+
+    def check_status(self):
+        """Updates the rate limit and the time of the next free slot from the server
+        status. Returns the number of seconds to wait, or None if unknown."""
+        try:
+            r = requests.get(self.server + 'status', timeout=30)
+        except requests.RequestException as e:
+            logging.debug('Could not get status of %s: %s', self.server, e)
+            return None
+        if r.status_code != 200:
+            return None
+        rate_limit, available, wait = parse_status(r.text)
+        logging.debug('Overpass API status: rate limit %s, %s slots available, next in %s s',
+                      rate_limit, available, wait)
+        with self.cond:
+            if rate_limit:
+                self.rate_limit = rate_limit
+                self.set_max_concurrent(self.max_concurrent)
+            if available == 0 and wait is not None:
+                self.postpone(wait)
+        if available is None:
+            return None
+        return wait if available == 0 else 0
+
+    def set_max_concurrent(self, max_concurrent):
+        """Changes the cap on simultaneous requests, still keeping under the rate limit."""
+        with self.cond:
+            self.max_concurrent = max_concurrent
+            self.limit = max(1, min(max_concurrent, self.rate_limit or max_concurrent))
+            self.cond.notify_all()
+
+    def postpone(self, seconds):
+        with self.cond:
+            self.not_before = max(self.not_before, time.time() + seconds)
+            self.cond.notify_all()
+
+    def acquire(self):
+        """Waits for a free slot and occupies it."""
+        if not self.status_checked:
+            # Other threads wait for the rate limit before their first requests
+            with self.status_lock:
+                if not self.status_checked:
+                    self.check_status()
+                    self.status_checked = True
+        started = time.time()
+        with self.cond:
+            while True:
+                now = time.time()
+                if now < self.not_before:
+                    self.cond.wait(self.not_before - now)
+                elif self.running >= self.limit:
+                    self.cond.wait()
+                else:
+                    self.running += 1
+                    break
+        waited = time.time() - started
+        if waited >= 1:
+            logging.info('Waited %.1f seconds in the queue for %s', waited, self.server)
+        else:
+            logging.debug('Waited %.1f seconds in the queue for %s', waited, self.server)
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify_all()
+
+    def send(self, query, method='get', fail_fast=False):
+        """Sends a query to the interpreter when a slot is free, retrying when rate limited.
+        With fail_fast, raises an error on the first 503 or 504 response instead,
+        so the query can go to another server.
+        Returns a streamed response, which keeps the slot until "release" is called."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                r = requests.request(method, self.server + 'interpreter',
+                                     params={'data': query} if method == 'get' else None,
+                                     data={'data': query} if method != 'get' else None,
+                                     stream=True)
+            except requests.RequestException:
+                self.release()
+                raise
+            if r.status_code not in (429, 503, 504):
+                return r
+            r.close()
+            self.release()
+            delay = parse_retry_after(r.headers.get('Retry-After'))
+            if delay is None and r.status_code == 429:
+                delay = self.check_status()
+            if delay is None:
+                delay = RETRY_DELAY * 2 ** attempt
+            if fail_fast and r.status_code != 429:
+                self.postpone(delay)
+                break
+            if attempt < self.max_retries:
+                logging.warning('%s responded with %s, retrying in %s seconds',
+                                self.server, r.status_code, round(delay))
+                self.postpone(delay)
+        if r.status_code == 429:
+            logging.warning('Seems like you are rate limited by %s', self.server)
+        raise IOError('{} responded with {}'.format(self.server, r.status_code))
+
+
+class ServerStats:
+    """Tracks latency and errors of an Overpass API server, as exponentially
+    weighted moving averages."""
+    def __init__(self, url, max_concurrent=None):
+        self.url = url
+        self.scheduler = get_scheduler(url, max_concurrent)
+        self.latency = DEFAULT_LATENCY
+        self.error_rate = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, latency=None):
+        """Records a successful request with its latency, or an error when it is None."""
+        with self.lock:
+            self.error_rate *= 1 - EWMA_ALPHA
+            if latency is None:
+                self.error_rate += EWMA_ALPHA
+            else:
+                self.latency += EWMA_ALPHA * (latency - self.latency)
+
+    @property
+    def weight(self):
+        return max(0.01, 1 - self.error_rate) ** 2 / max(0.01, self.latency)
+
+
+class OverpassPool:
+    """A pool of Overpass API servers.
+
+    Requests go to a server chosen randomly with weights based on its latency
+    and error rate. When a server fails, the request is sent to another one.
+    When "hedge_after" is set and a server does not respond in that many seconds,
+    the request is also sent to a second server, and the first response wins.
+    "max_concurrent" caps simultaneous requests to each server.
+    """
+    def __init__(self, servers=None, hedge_after=None, max_concurrent=None):
+        self.servers = [ServerStats(url, max_concurrent)
+                        for url in (servers or [OVERPASS_SERVER])]
+        self.hedge_after = hedge_after
+
+    @property
+    def key(self):
+        """A string to identify responses from this pool."""
+        return ','.join(sorted(s.url for s in self.servers))
+
+    def choose(self, exclude=()):
+        """Returns a random server weighted by its health, or None.
+        Servers that postponed requests after errors are chosen only
+        when all others did too."""
+        candidates = [s for s in self.servers if s not in exclude]
+        if not candidates:
+            return None
+        now = time.time()
+        ready = [s for s in candidates if s.scheduler.not_before <= now]
+        candidates = ready or candidates
+        return random.choices(candidates, [s.weight for s in candidates])[0]
+
+    def send(self, query, method='get'):
+        """Sends a query to servers in the pool, with failover and hedging.
+        Returns a tuple of (server, response). The response keeps a slot
+        in the server scheduler until it is released."""
+        results = queue.Queue()
+        tried = []
+
+        def attempt(server, fail_fast):
+            started = time.time()
+            try:
+                r = server.scheduler.send(query, method, fail_fast)
+            except Exception as e:
+                server.record()
+                results.put((server, None, e))
+                return
+            server.record(time.time() - started)
+            results.put((server, r, None))
+
+        def launch(server):
+            tried.append(server)
+            # Server errors are not retried while there are other servers to try
+            fail_fast = len(tried) < len(self.servers)
+            threading.Thread(target=attempt, args=(server, fail_fast), daemon=True).start()
+
+        def discard(count):
+            """Closes responses that came after the winner."""
+            for _ in range(count):
+                server, r, _ = results.get()
+                if r is not None:
+                    r.close()
+                    server.scheduler.release()
+
+        launch(self.choose())
+        pending = 1
+        error = None
+        while pending:
+            hedge = self.hedge_after is not None and pending == 1 and len(tried) < len(
+                self.servers)
+            try:
+                server, r, e = results.get(timeout=self.hedge_after if hedge else None)
+            except queue.Empty:
+                second = self.choose(exclude=tried)
+                logging.info('%s is slow, sending the request to %s too',
+                             tried[-1].url, second.url)
+                launch(second)
+                pending += 1
+                continue
+            pending -= 1
+            if r is None:
+                error = e
+                logging.warning('Request to %s failed: %s', server.url, e)
+                if not pending:
+                    next_server = self.choose(exclude=tried)
+                    if next_server is not None:
+                        launch(next_server)
+                        pending += 1
+                continue
+            if pending:
+                threading.Thread(target=discard, args=(pending,), daemon=True).start()
+            return server, r
+        raise IOError('All Overpass API servers failed, the last error: {}'.format(error))
+
+    @contextmanager
+    def request(self, query, method='get'):
+        """Yields a streamed response for a query, keeping the slot until it is read."""
+        server, r = self.send(query, method)
+        try:
+            with r:
+                yield r
+        finally:
+            server.scheduler.release()
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(server, max_concurrent=None):
+    """Returns a scheduler for a server, shared by all downloaders.
+    Updates its cap on simultaneous requests when max_concurrent is set."""
+    with _schedulers_lock:
+        if server not in _schedulers:
+            _schedulers[server] = OverpassScheduler(server, max_concurrent or MAX_CONCURRENT)
+        elif max_concurrent:
+            _schedulers[server].set_max_concurrent(max_concurrent)
+        return _schedulers[server]
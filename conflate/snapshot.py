@@ -0,0 +1,354 @@
+import gzip
+import hashlib
+import logging
+import os
+import pickle
+import types
+from collections import defaultdict
+from . import etree
+from .osm import OsmDownloader
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+
+class Snapshot:
+    """A local copy of OSM data, which can be updated with replication diffs.
+
+    Keeps coordinates of all nodes, and records (see OsmDownloader.parse_element)
+    for tagged objects. Categories of objects for the last used profile are
+    stored too, so after applying diffs only touched objects are classified again.
+    Diffs do not go back past object versions and the time of the source extract.
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.objects = {}
+        self.applied = set()
+        self.signature = None
+        self.categories = {}
+        # The latest edit in the source extract, as an ISO 8601 string
+        self.timestamp = None
+        # Whether the source has all objects in the area, and not just query results,
+        # so nodes outside of known ways are not in any way
+        self.full_extract = False
+        # Whether it differs from the saved file
+        self.changed = True
+
+    @staticmethod
+    def load(filename):
+        """Reads a binary snapshot, or makes one from an OSM XML or PBF file."""
+        if filename.endswith('.pbf'):
+            snapshot = Snapshot()
+            snapshot.read_pbf(filename)
+            return snapshot
+        with open(filename, 'rb') as f:
+            is_gzip = f.read(2) == b'\x1f\x8b'
+        with (gzip.open if is_gzip else open)(filename, 'rb') as f:
+            if f.peek(1)[:1] == b'<':
+                snapshot = Snapshot()
+                snapshot.read_xml(f)
+                return snapshot
+            return pickle.load(f)
+
+    def save(self, filename):
+        tmp_name = filename + '.tmp'
+        self.changed = False
+        with gzip.open(tmp_name, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_name, filename)
+
+    def read_xml(self, fileobj):
+        """Adds all objects from an OSM XML file."""
+        ways = {}
+        depth = 0
+        root = None
+        for event, el in etree.iterparse(fileobj, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = el
+                    # Overpass API responses have only objects matching a query
+                    self.full_extract = not (el.get('generator') or '').startswith(
+                        'Overpass API')
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                timestamp = el.get('timestamp')
+                if timestamp and (self.timestamp is None or timestamp > self.timestamp):
+                    self.timestamp = timestamp
+                self.add(el, ways)
+                root.remove(el)
+        logging.info('Read %s nodes and %s objects into the snapshot',
+                     len(self.nodes), len(self.objects))
+
+    def read_pbf(self, filename):
+        """Adds all objects from an OSM PBF file. Requires the osmium module."""
+        if osmium is None:
+            raise ImportError('Please install the osmium module to read PBF files')
+        snapshot = self
+
+        def center(coords):
+            coords = [c for c in coords if c is not None]
+            if not coords:
+                return None
+            return [sum(c[0] for c in coords) / len(coords),
+                    sum(c[1] for c in coords) / len(coords)]
+
+        class Handler(osmium.SimpleHandler):
+            def node(self, n):
+                coord = (n.location.lat, n.location.lon)
+                snapshot.nodes[n.id] = coord
+                if len(n.tags):
+                    snapshot.objects[('node', n.id)] = [
+                        'node', n.id, n.version, coord[0], coord[1],
+                        {t.k: t.v for t in n.tags}, None]
+
+            def way(self, w):
+                refs = [nd.ref for nd in w.nodes]
+                coord = center([snapshot.nodes.get(ref) for ref in refs])
+                if coord:
+                    snapshot.objects[('way', w.id)] = [
+                        'way', w.id, w.version, coord[0], coord[1],
+                        {t.k: t.v for t in w.tags}, [str(ref) for ref in refs]]
+
+            def relation(self, r):
+                members = [(m.type, m.ref, m.role) for m in r.members]
+                coords = []
+                for m in members:
+                    if m[0] == 'n':
+                        coords.append(snapshot.nodes.get(m[1]))
+                    elif m[0] == 'w' and ('way', m[1]) in snapshot.objects:
+                        coords.append(snapshot.objects[('way', m[1])][3:5])
+                coord = center(coords)
+                if coord:
+                    types = {'n': 'node', 'w': 'way', 'r': 'relation'}
+                    snapshot.objects[('relation', r.id)] = [
+                        'relation', r.id, r.version, coord[0], coord[1],
+                        {t.k: t.v for t in r.tags},
+                        [(types[m[0]], str(m[1]), m[2]) for m in members]]
+
+        Handler().apply_file(filename)
+        self.full_extract = True
+        reader = osmium.io.Reader(filename, osmium.osm.osm_entity_bits.NOTHING)
+        self.timestamp = reader.header().get('osmosis_replication_timestamp') or None
+        reader.close()
+        logging.info('Read %s nodes and %s objects into the snapshot',
+                     len(self.nodes), len(self.objects))
+
+    def add(self, el, ways=None):
+        """Adds or replaces an object from an XML element. Returns its key."""
+        nodes = {}
+        if el.tag != 'node':
+            # Only member coordinates are needed for finding centers
+            refs = [nd.get('ref') for nd in el.findall('nd')]
+            refs.extend(m.get('ref') for m in el.findall('member') if m.get('type') == 'node')
+            nodes = {ref: self.nodes[int(ref)] for ref in refs if int(ref) in self.nodes}
+        if ways is None:
+            ways = {}
+            for m in el.findall('member'):
+                way = self.objects.get(('way', int(m.get('ref'))))
+                if m.get('type') == 'way' and way:
+                    ways[m.get('ref')] = way[3:5]
+        record = OsmDownloader.parse_element(el, nodes, ways)
+        if el.tag == 'node':
+            self.nodes[int(el.get('id'))] = (float(el.get('lat')), float(el.get('lon')))
+        key = (el.tag, int(el.get('id')))
+        if record is None or (el.tag == 'node' and not record[5]):
+            self.objects.pop(key, None)
+        else:
+            self.objects[key] = list(record)
+        self.categories.pop(key, None)
+        return key
+
+    def delete(self, el):
+        key = (el.tag, int(el.get('id')))
+        if el.tag == 'node':
+            self.nodes.pop(key[1], None)
+        self.objects.pop(key, None)
+        self.categories.pop(key, None)
+        return key
+
+    def update_center(self, key):
+        """Sets the center of a way or a relation to the mean of known coordinates
+        of its nodes and centers of its ways, like "parse_element" does."""
+        record = self.objects.get(key)
+        if not record or not record[6]:
+            return
+        if key[0] == 'way':
+            coords = [self.nodes.get(int(ref)) for ref in record[6]]
+        else:
+            coords = []
+            for m in record[6]:
+                if m[0] == 'node':
+                    coords.append(self.nodes.get(int(m[1])))
+                elif m[0] == 'way' and ('way', int(m[1])) in self.objects:
+                    coords.append(self.objects[('way', int(m[1]))][3:5])
+        coords = [c for c in coords if c is not None]
+        if coords:
+            record[3] = sum(c[0] for c in coords) / len(coords)
+            record[4] = sum(c[1] for c in coords) / len(coords)
+
+    def is_stale(self, el):
+        """Checks whether an element from a diff is not newer than
+        the stored object, or than the source extract."""
+        record = self.objects.get((el.tag, int(el.get('id'))))
+        if record and record[2] is not None and el.get('version'):
+            return int(el.get('version')) <= int(record[2])
+        timestamp = el.get('timestamp')
+        return bool(self.timestamp and timestamp and timestamp <= self.timestamp)
+
+    def apply_osc(self, fileobj, node_ways=None, member_relations=None):
+        """Applies an osmChange file, skipping stale elements (see "is_stale").
+        Returns a set of keys of changed objects, including ways and relations
+        which members were moved. Pass results of "get_node_ways" and
+        "get_member_relations" to avoid looking through all objects."""
+        if node_ways is None:
+            node_ways = self.get_node_ways()
+        if member_relations is None:
+            member_relations = self.get_member_relations()
+        touched = set()
+        moved_nodes = set()
+        action = None
+        depth = 0
+        for event, el in etree.iterparse(fileobj, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 2:
+                    action = el
+                continue
+            depth -= 1
+            if depth != 2:
+                continue
+            if self.is_stale(el):
+                action.remove(el)
+                continue
+            if el.tag == 'node':
+                old = self.nodes.get(int(el.get('id')))
+                if old != (float(el.get('lat', 'nan')), float(el.get('lon', 'nan'))):
+                    moved_nodes.add(el.get('id'))
+            if action.tag == 'delete':
+                touched.add(self.delete(el))
+            else:
+                touched.add(self.add(el))
+                if el.tag == 'way':
+                    for nd in el.findall('nd'):
+                        node_ways[nd.get('ref')].add(int(el.get('id')))
+                elif el.tag == 'relation':
+                    for m in el.findall('member'):
+                        member_relations[(m.get('type'), m.get('ref'))].add(int(el.get('id')))
+            action.remove(el)
+
+        # Ways and then relations with moved members get new centers
+        ways = {key[1] for key in touched if key[0] == 'way'}
+        for node_id in moved_nodes:
+            ways.update(node_ways.get(node_id, ()))
+        relations = set()
+        for member in [('node', n) for n in moved_nodes] + [('way', str(w)) for w in ways]:
+            relations.update(member_relations.get(member, ()))
+        for key in [('way', w) for w in ways] + [('relation', r) for r in relations]:
+            if key in self.objects:
+                self.update_center(key)
+                if key not in touched:
+                    self.categories.pop(key, None)
+                    touched.add(key)
+        if touched:
+            self.changed = True
+        return touched
+
+    def apply_diffs(self, path):
+        """Applies all osmChange files from a directory (including subdirectories
+        of a replication tree) in order of their names, skipping already applied ones.
+        Returns a set of keys of changed objects."""
+        filenames = []
+        for dirpath, _, names in os.walk(path):
+            for name in names:
+                if name.endswith('.osc') or name.endswith('.osc.gz'):
+                    filenames.append(os.path.relpath(os.path.join(dirpath, name), path))
+        touched = set()
+        count = 0
+        node_ways = self.get_node_ways()
+        member_relations = self.get_member_relations()
+        for name in sorted(filenames):
+            if name in self.applied:
+                continue
+            opener = gzip.open if name.endswith('.gz') else open
+            with opener(os.path.join(path, name), 'rb') as f:
+                touched.update(self.apply_osc(f, node_ways, member_relations))
+            self.applied.add(name)
+            self.changed = True
+            count += 1
+        logging.info('Applied %s diffs, %s objects changed', count, len(touched))
+        return touched
+
+    def get_node_ways(self):
+        """Returns a dict of node id (as a string) -> set of ids of ways with that node."""
+        result = defaultdict(set)
+        for key, record in self.objects.items():
+            if key[0] == 'way' and record[6]:
+                for ref in record[6]:
+                    result[ref].add(key[1])
+        return result
+
+    def get_member_relations(self):
+        """Returns a dict of (member type, id as a string) -> set of ids of relations
+        with that member."""
+        result = defaultdict(set)
+        for key, record in self.objects.items():
+            if key[0] == 'relation' and record[6]:
+                for m in record[6]:
+                    result[(m[0], m[1])].add(key[1])
+        return result
+
+    def get_osmdata(self, downloader, bboxes=None):
+        """Makes OSMPoints out of the snapshot for the downloader profile,
+        limited to bboxes like an Overpass API query would be.
+        Reuses categories from the last run with the same profile query."""
+        profile = downloader.profile
+        ref_key = None
+        if not profile.get('no_dataset_id', False) and not profile.get('bounded_update', False):
+            ref_key = 'ref:' + profile.get('dataset_id')
+        if bboxes and None in bboxes:
+            bboxes = None
+        signature = hashlib.sha1(stable_repr((
+            downloader.get_tag_strings(), profile.get_raw('categories'),
+            profile.get_raw('qualifies'))).encode('utf-8')).hexdigest()
+        if signature != self.signature:
+            self.signature = signature
+            self.categories = {}
+            self.changed = True
+        count = 0
+        osmdata = {}
+        for key, record in self.objects.items():
+            if bboxes and record[5].get(ref_key) is None and not any(
+                    b[0] <= record[3] <= b[2] and b[1] <= record[4] <= b[3] for b in bboxes):
+                continue
+            categories = self.categories.get(key)
+            if categories is None:
+                count += 1
+                categories = downloader.get_categories(record[5]) or set()
+                self.categories[key] = categories
+                self.changed = True
+            if categories:
+                pt = downloader.make_point(record, categories)
+                if pt is not None:
+                    osmdata[pt.id] = pt
+        logging.debug('Classified %s objects of %s in the snapshot', count, len(self.objects))
+        return osmdata
+
+
+def stable_repr(value):
+    """Returns a repr of a value that does not change between runs:
+    functions are replaced with their bytecode, and sets are sorted."""
+    if isinstance(value, types.FunctionType):
+        value = value.__code__
+    if isinstance(value, types.CodeType):
+        return stable_repr((value.co_code, value.co_names, value.co_consts))
+    if isinstance(value, (list, tuple)):
+        return '({})'.format(', '.join(stable_repr(v) for v in value))
+    if isinstance(value, dict):
+        return '{{{}}}'.format(', '.join(sorted(
+            '{}: {}'.format(stable_repr(k), stable_repr(v)) for k, v in value.items())))
+    if isinstance(value, (set, frozenset)):
+        return '{{{}}}'.format(', '.join(sorted(stable_repr(v) for v in value)))
+    return repr(value)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""A local stand-in for Overpass API and OSM API servers, for testing
+the conflator without network.
+
+Run it with "python -m conflate.standin --osm data.osm", and then point
+the conflator at it with "--overpass http://localhost:8000/api/
+--osm-api http://localhost:8000/api/0.6/".
+
+To replay real responses, run the conflator against real servers with
+"--cache-dir responses", and serve them with "--responses responses".
+When the conflator used other servers than the default one, pass
+the same list with "--recorded-from".
+"""
+import argparse
+import gzip
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from . import etree
+from .cache import ResponseCache
+from .overpass import OVERPASS_SERVER
+from .snapshot import Snapshot
+
+
+class StandIn:
+    """Responses and faults of the stand-in server.
+
+    Interpreter queries are answered with a recorded response from the "responses"
+    directory, which is a response cache of the conflator: files are named after
+    ResponseCache.key(servers, query) with ".osm" or ".osm.gz" extension, where
+    "recorded_from" is a list of servers the responses came from.
+    Otherwise queries get the contents of the "osm" file. The same file is used
+    for answering "node/{id}/ways" OSM API requests. Files from the "files"
+    directory are served under /files/, e.g. for the "download_url" profile variable.
+    Changesets can be opened, uploaded to and closed like in OSM API, and uploads
+    get new ids and versions for objects without checking them.
+
+    Every request is delayed by "latency" seconds plus a random "jitter",
+    fails with 504 with "error_rate" probability, and hangs for "timeout" seconds
+    and then drops the connection with "timeout_rate" probability.
+    When more than "rate_limit" interpreter queries run at once,
+    the rest get 429 responses with a Retry-After header.
+    """
+    def __init__(self, osm=None, responses=None, files=None, latency=0, jitter=0,
+                 error_rate=0, timeout_rate=0, timeout=300, rate_limit=None, seed=None,
+                 recorded_from=None):
+        self.responses = responses
+        # The same as OverpassPool.key of the recording conflator
+        self.servers_key = ','.join(sorted(recorded_from or [OVERPASS_SERVER]))
+        self.files = files
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.osm_data = b'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6"></osm>'
+        self.snapshot = Snapshot()
+        if osm:
+            with open(osm, 'rb') as f:
+                self.osm_data = f.read()
+            self.snapshot = Snapshot.load(osm)
+        self.node_ways = self.snapshot.get_node_ways()
+        self.changesets = {}  # id -> True if open
+        self.last_id = 1000000
+
+    def next_id(self):
+        with self.lock:
+            self.last_id += 1
+            return self.last_id
+
+    def create_changeset(self):
+        changeset = self.next_id()
+        self.changesets[changeset] = True
+        return str(changeset).encode('utf-8')
+
+    def upload(self, changeset, data):
+        """Returns a diffResult for an osmChange upload, or None
+        if the changeset is not open."""
+        if not self.changesets.get(changeset):
+            return None
+        result = etree.Element('diffResult', version='0.6')
+        for action in etree.fromstring(data):
+            for el in action:
+                res = etree.SubElement(result, el.tag, old_id=el.get('id'))
+                if action.tag == 'create':
+                    res.set('new_id', str(self.next_id()))
+                    res.set('new_version', '1')
+                elif action.tag == 'modify':
+                    res.set('new_id', el.get('id'))
+                    res.set('new_version', str(int(el.get('version')) + 1))
+        return etree.tostring(result, encoding='utf-8')
+
+    def roll(self, probability):
+        with self.lock:
+            return self.random.random() < probability
+
+    def delay(self):
+        with self.lock:
+            seconds = self.latency + self.random.random() * self.jitter
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def acquire(self):
+        """Occupies an interpreter slot. Returns False if all slots are taken."""
+        with self.lock:
+            if self.rate_limit is not None and self.running >= self.rate_limit:
+                return False
+            self.running += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.running -= 1
+
+    def get_status(self):
+        """Returns a text like the one from /status of Overpass API."""
+        now = datetime.now(timezone.utc)
+        lines = [
+            'Connected as: 1',
+            'Current time: {}'.format(now.strftime('%Y-%m-%dT%H:%M:%SZ')),
+            'Rate limit: {}'.format(self.rate_limit or 0),
+        ]
+        with self.lock:
+            free = None if self.rate_limit is None else self.rate_limit - self.running
+        if free is None or free > 0:
+            lines.append('{} slots available now.'.format(free or 2))
+        else:
+            after = now + timedelta(seconds=self.latency + 1)
+            lines.append('Slot available after: {}, in {} seconds.'.format(
+                after.strftime('%Y-%m-%dT%H:%M:%SZ'), round(self.latency + 1)))
+        lines.append('Currently running queries (pid, space limit, time limit, start time):')
+        return '\n'.join(lines) + '\n'
+
+    def get_response(self, query):
+        """Returns a recorded response for the query, or the OSM file."""
+        if self.responses:
+            key = ResponseCache.key(self.servers_key, query)
+            for ext, opener in (('.osm', open), ('.osm.gz', gzip.open)):
+                filename = os.path.join(self.responses, key + ext)
+                if os.path.exists(filename):
+                    with opener(filename, 'rb') as f:
+                        return f.read()
+            logging.debug('No recorded response for %s', key)
+        return self.osm_data
+
+    def get_node_ways(self, node_id):
+        """Returns an OSM API response with ways that contain the node."""
+        result = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+        for way_id in sorted(self.node_ways.get(str(node_id), ())):
+            record = self.snapshot.objects[('way', way_id)]
+            result.append(' <way id="{}" version="{}">'.format(way_id, record[2]))
+            result.extend('  <nd ref="{}"/>'.format(ref) for ref in record[6])
+            result.append(' </way>')
+        result.append('</osm>')
+        return '\n'.join(result).encode('utf-8')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.route(url.path, parse_qs(url.query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        path = urlparse(self.path).path
+        if path.startswith('/api/0.6/changeset/'):
+            self.route(path, {}, body)
+        else:
+            self.route(path, parse_qs(body.decode('utf-8')))
+
+    def do_PUT(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.route(urlparse(self.path).path, {}, self.rfile.read(length))
+
+    def send(self, code, body=b'', content_type='application/osm3s+xml', headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, path, params, body=None):
+        standin = self.server.standin
+        if path == '/api/status':
+            self.send(200, standin.get_status().encode('utf-8'), 'text/plain')
+            return
+        is_query = path == '/api/interpreter'
+        if is_query and not standin.acquire():
+            self.send(429, b'Too many requests', 'text/plain',
+                      {'Retry-After': str(round(standin.latency + 1))})
+            return
+        try:
+            standin.delay()
+            if standin.roll(standin.timeout_rate):
+                time.sleep(standin.timeout)
+                self.close_connection = True
+                return
+            if standin.roll(standin.error_rate):
+                self.send(504, b'Gateway Timeout', 'text/plain')
+            elif is_query:
+                self.send(200, standin.get_response(params.get('data', [''])[0]))
+            elif path.startswith('/api/0.6/changeset/'):
+                self.changeset(path[len('/api/0.6/changeset/'):], body)
+            elif path.startswith('/api/0.6/node/') and path.endswith('/ways'):
+                node_id = path[len('/api/0.6/node/'):-len('/ways')]
+                self.send(200, standin.get_node_ways(node_id), 'text/xml')
+            elif path.startswith('/files/') and standin.files:
+                self.send_file(os.path.join(standin.files, path[len('/files/'):]))
+            else:
+                self.send(404, b'Not found', 'text/plain')
+        finally:
+            if is_query:
+                standin.release()
+
+    def changeset(self, path, body):
+        standin = self.server.standin
+        parts = path.split('/')
+        if parts == ['create'] and self.command == 'PUT':
+            self.send(200, standin.create_changeset(), 'text/plain')
+            return
+        changeset = int(parts[0]) if parts[0].isdigit() else None
+        if changeset not in standin.changesets or len(parts) != 2:
+            self.send(404, b'Not found', 'text/plain')
+        elif parts[1] == 'close' and self.command == 'PUT':
+            standin.changesets[changeset] = False
+            self.send(200, b'', 'text/plain')
+        elif parts[1] == 'upload' and self.command == 'POST':
+            result = standin.upload(changeset, body)
+            if result is None:
+                self.send(409, 'The changeset {} was closed'.format(changeset).encode('utf-8'),
+                          'text/plain')
+            else:
+                self.send(200, result, 'text/xml')
+        else:
+            self.send(404, b'Not found', 'text/plain')
+
+    def send_file(self, filename):
+        root = os.path.abspath(self.server.standin.files)
+        filename = os.path.abspath(filename)
+        if not filename.startswith(root + os.sep) or not os.path.isfile(filename):
+            self.send(404, b'Not found', 'text/plain')
+            return
+        with open(filename, 'rb') as f:
+            self.send(200, f.read(), 'application/octet-stream')
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s', self.address_string(), format % args)
+
+
+def make_server(standin, host='localhost', port=8000):
+    """Returns an HTTP server for the stand-in. Call "serve_forever" on it,
+    possibly in a thread, and "shutdown" to stop it."""
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    server.daemon_threads = True
+    server.standin = standin
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serves recorded or synthetic Overpass API and OSM API responses, '
+        'with injected latency, errors, timeouts and rate limits.')
+    parser.add_argument('--osm', help='OSM XML file to return for any query')
+    parser.add_argument('--responses',
+                        help='Directory with recorded responses for queries, '
+                        'e.g. a --cache-dir of the conflator')
+    parser.add_argument('--recorded-from', action='append',
+                        help='Overpass API server the responses were recorded from, '
+                        'if not the default one, can be specified multiple times')
+    parser.add_argument('--files', help='Directory with files to serve under /files/')
+    parser.add_argument('--host', default='localhost', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Delay before each response, in seconds')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='Maximum random delay added to the latency, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Share of requests that fail with 504')
+    parser.add_argument('--timeout-rate', type=float, default=0,
+                        help='Share of requests that hang and drop the connection')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='How long hanging requests hang, in seconds')
+    parser.add_argument('--rate-limit', type=int,
+                        help='Maximum number of simultaneous queries, others get 429')
+    parser.add_argument('--seed', type=int, help='Random seed for reproducible faults')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every request')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO,
+                        format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
+    standin = StandIn(options.osm, options.responses, options.files, options.latency,
+                      options.jitter, options.error_rate, options.timeout_rate,
+                      options.timeout, options.rate_limit, options.seed,
+                      options.recorded_from)
+    server = make_server(standin, options.host, options.port)
+    url = 'http://{}:{}/'.format(options.host, server.server_address[1])
+    logging.info('Serving on %s, use "--overpass %sapi/ --osm-api %sapi/0.6/"', url, url, url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import requests
+from . import etree
+from .conflator import sort_by_hilbert
+from .osm import OSM_API_SERVER
+
+
+BATCH_SIZE = 1000  # objects in one diff upload
+CHANGESET_SIZE = 10000  # the OSM API limit
+MAX_RETRIES = 5
+RETRY_DELAY = 5  # in seconds, doubled on each retry
+
+
+class UploadError(IOError):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class Uploader:
+    """Uploads changes to OSM API.
+
+    Objects are ordered along a Hilbert curve and split into changesets,
+    which are uploaded in batches of diff uploads. New ids and versions
+    from each batch are applied to references in the following batches.
+    All results are written to a journal file, so an interrupted upload
+    skips objects that have been uploaded when restarted with the same journal.
+    The journal keeps a fingerprint of the changes, and is refused for other
+    changes, since ids of created objects are not stable between them.
+    It is removed when the upload is finished.
+    """
+    def __init__(self, api=OSM_API_SERVER, token=None, tags=None, journal=None,
+                 batch_size=BATCH_SIZE, changeset_size=CHANGESET_SIZE):
+        self.api = api
+        self.tags = tags or {}
+        self.journal = journal
+        self.batch_size = batch_size
+        self.changeset_size = changeset_size
+        self.session = requests.Session()
+        if token:
+            self.session.headers['Authorization'] = 'Bearer ' + token
+        self.changeset = None
+        self.changeset_count = 0
+        self.opened = set()
+        # (type, old id) -> (new id, new version or None if deleted)
+        self.uploaded = {}
+        # Of changes in the journal, False when there is no journal
+        self.fingerprint = False
+        self.load_journal()
+
+    def load_journal(self):
+        if not self.journal or not os.path.exists(self.journal):
+            return
+        self.fingerprint = None
+        with open(self.journal, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if 'fingerprint' in entry:
+                    self.fingerprint = entry['fingerprint']
+                elif 'open' in entry:
+                    self.changeset = entry['open']
+                    self.changeset_count = 0
+                elif 'closed' in entry:
+                    self.changeset = None
+                elif 'results' in entry:
+                    for osm_type, old_id, new_id, version in entry['results']:
+                        self.uploaded[(osm_type, old_id)] = (new_id, version)
+                    self.changeset_count += len(entry['results'])
+        logging.info('Found %s uploaded objects in the journal', len(self.uploaded))
+
+    @staticmethod
+    def get_fingerprint(points):
+        """Returns a hash of actions and contents of OSMPoints."""
+        fingerprint = hashlib.sha1()
+        for p in sorted(points, key=lambda p: (p.osm_type, p.osm_id)):
+            fingerprint.update(p.action.encode('utf-8'))
+            fingerprint.update(etree.tostring(p.to_xml(), encoding='utf-8'))
+        return fingerprint.hexdigest()
+
+    def finish(self):
+        if self.journal and os.path.exists(self.journal):
+            os.remove(self.journal)
+            logging.info('Upload is complete, removed the journal %s', self.journal)
+
+    def log(self, entry):
+        if self.journal:
+            with open(self.journal, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def request(self, method, path, data=None):
+        """Sends a request to OSM API, retrying on server errors and rate limits.
+        Requests that create objects are retried only when they were surely
+        not applied: on 429 and 503 responses. Returns the response text."""
+        # Closing a changeset can be repeated safely, unlike creating objects
+        idempotent = path.endswith('/close')
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                r = self.session.request(method, self.api + path, data=data,
+                                         headers={'Content-Type': 'text/xml'}, timeout=300)
+            except requests.ConnectTimeout as e:
+                if attempt == MAX_RETRIES:
+                    raise UploadError('Could not connect to {}: {}'.format(self.api, e))
+                status = None
+            except requests.RequestException as e:
+                # The server might have applied the request
+                if not idempotent or attempt == MAX_RETRIES:
+                    raise UploadError('{} {} failed, please check the changeset: {}'.format(
+                        method, path, e))
+                status = None
+            else:
+                if r.status_code == 200:
+                    return r.text
+                status = r.status_code
+                if status not in (429, 500, 502, 503, 504) or attempt == MAX_RETRIES:
+                    raise UploadError('{} {} failed with {}: {}'.format(
+                        method, path, status, r.text), status)
+                if status not in (429, 503) and not idempotent:
+                    # A gateway error can come after the server has applied the request
+                    raise UploadError(
+                        '{} {} failed with {}, please check the changeset and resume '
+                        'with the journal: {}'.format(method, path, status, r.text), status)
+            delay = RETRY_DELAY * 2 ** attempt
+            logging.warning('%s %s failed with %s, retrying in %s seconds',
+                            method, path, status or 'a connection error', delay)
+            time.sleep(delay)
+
+    def open_changeset(self):
+        osm = etree.Element('osm')
+        changeset = etree.SubElement(osm, 'changeset')
+        for k, v in self.tags.items():
+            etree.SubElement(changeset, 'tag', k=k, v=v)
+        self.changeset = int(self.request(
+            'PUT', 'changeset/create', etree.tostring(osm, encoding='utf-8')))
+        self.changeset_count = 0
+        self.opened.add(self.changeset)
+        self.log({'open': self.changeset})
+        logging.info('Opened changeset %s', self.changeset)
+
+    def close_changeset(self):
+        self.request('PUT', 'changeset/{}/close'.format(self.changeset))
+        self.log({'closed': self.changeset})
+        logging.info('Closed changeset %s', self.changeset)
+        self.changeset = None
+
+    def to_xml(self, p):
+        """Makes an XML element for an OSMPoint, replacing ids and versions
+        of already uploaded objects."""
+        el = p.to_xml()
+        el.set('changeset', str(self.changeset))
+        mapped = self.uploaded.get((p.osm_type, p.osm_id))
+        if mapped:
+            el.set('id', str(mapped[0]))
+            el.set('version', str(mapped[1]))
+        for nd in el.findall('nd'):
+            mapped = self.uploaded.get(('node', int(nd.get('ref'))))
+            if mapped and mapped[0] is not None:
+                nd.set('ref', str(mapped[0]))
+        for m in el.findall('member'):
+            mapped = self.uploaded.get((m.get('type'), int(m.get('ref'))))
+            if mapped and mapped[0] is not None:
+                m.set('ref', str(mapped[0]))
+        return el
+
+    def upload_batch(self, points):
+        osc = etree.Element('osmChange', version='0.6')
+        for p in points:
+            action = etree.SubElement(osc, p.action)
+            if p.action == 'delete':
+                # Keep objects which are still used by ways or relations
+                action.set('if-unused', 'true')
+            action.append(self.to_xml(p))
+        result = etree.fromstring(self.request(
+            'POST', 'changeset/{}/upload'.format(self.changeset),
+            etree.tostring(osc, encoding='utf-8')).encode('utf-8'))
+        results = []
+        for el in result:
+            new_id = el.get('new_id')
+            version = el.get('new_version')
+            results.append([el.tag, int(el.get('old_id')),
+                            None if new_id is None else int(new_id),
+                            None if version is None else int(version)])
+        for osm_type, old_id, new_id, version in results:
+            self.uploaded[(osm_type, old_id)] = (new_id, version)
+        self.changeset_count += len(results)
+        self.log({'changeset': self.changeset, 'results': results})
+
+    def upload(self, points):
+        """Uploads OSMPoints with actions. Returns the number of uploaded objects."""
+        points = [p for p in points if p.action is not None]
+        fingerprint = self.get_fingerprint(points)
+        if self.fingerprint is False:
+            self.fingerprint = fingerprint
+            self.log({'fingerprint': fingerprint})
+        elif self.fingerprint != fingerprint:
+            raise UploadError('The journal {} is for other changes, remove it '
+                              'to start a new upload'.format(self.journal))
+        points = [p for p in points if (p.osm_type, p.osm_id) not in self.uploaded]
+        if not points:
+            logging.info('Nothing to upload')
+            self.finish()
+            return 0
+        sort_by_hilbert(points)
+        logging.info('Uploading %s objects', len(points))
+        i = 0
+        while i < len(points):
+            if self.changeset is not None and self.changeset_count >= self.changeset_size:
+                self.close_changeset()
+            if self.changeset is None:
+                self.open_changeset()
+            size = min(self.batch_size, self.changeset_size - self.changeset_count)
+            try:
+                self.upload_batch(points[i:i+size])
+            except UploadError as e:
+                if e.status != 409 or 'closed' not in str(e) or self.changeset in self.opened:
+                    raise
+                # The changeset from the journal was closed by the server
+                logging.warning('Changeset %s was closed: %s', self.changeset, e)
+                self.log({'closed': self.changeset})
+                self.changeset = None
+                continue
+            i += size
+            logging.info('Uploaded %s of %s objects', min(i, len(points)), len(points))
+        self.close_changeset()
+        self.finish()
+        return len(points)
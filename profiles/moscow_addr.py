@@ -3,6 +3,8 @@ no_dataset_id = True
 query = [('building',)]
 max_distance = 50
 max_request_boxes = 2
+# Download building outlines only for matched buildings
+defer_members = True
 master_tags = ('addr:housenumber', 'addr:street')
 
 COMPLEX = False